@@ -4,7 +4,13 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import numpy, sitkUtils, math
+import collections, hashlib, multiprocessing, re, shutil, tempfile, threading, time
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 import SimpleITK as sitk
+from vtk.util import numpy_support
 #
 # VentriculostomySurfaceCut
 #
@@ -43,15 +49,7 @@ class VentriculostomySurfaceCutWidget(ScriptedLoadableModuleWidget):
     ScriptedLoadableModuleWidget.setup(self)
     
     # Instantiate and connect widgets ...
-    segmentationWidget = slicer.modules.segmentations.widgetRepresentation() 
-    self.activeSegmentSelector = segmentationWidget.findChild("qMRMLNodeComboBox", "MRMLNodeComboBox_Segmentation")
-    self.labelMapSelector = segmentationWidget.findChild("qMRMLNodeComboBox", "MRMLNodeComboBox_ImportExportNode")
-    self.importRadioButton = segmentationWidget.findChild("QRadioButton", "radioButton_Import")
-    self.exportRadioButton = segmentationWidget.findChild("QRadioButton", "radioButton_Export")
-    self.labelMapRadioButton = segmentationWidget.findChild("QRadioButton", "radioButton_Labelmap")
-    self.modelsRadioButton = segmentationWidget.findChild("QRadioButton", "radioButton_Model")
-    self.portPushButton = segmentationWidget.findChild("ctkPushButton", "PushButton_ImportExport")             
-          
+
     #
     # Parameters Area
     #
@@ -118,6 +116,65 @@ class VentriculostomySurfaceCutWidget(ScriptedLoadableModuleWidget):
     self.imageThresholdSliderWidget.setToolTip("Set threshold value for computing the output image. Voxels that have intensities lower than this value will set to zero.")
     parametersFormLayout.addRow("Image threshold", self.imageThresholdSliderWidget)
 
+    #
+    # sampling factor
+    #
+    self.samplingFactorComboBox = qt.QComboBox()
+    self.samplingFactorComboBox.addItems(["1", "2", "4"])
+    self.samplingFactorComboBox.setToolTip("Downsample the volume by this factor before the morphology. Faster, but coarser surface.")
+    parametersFormLayout.addRow("Sampling factor", self.samplingFactorComboBox)
+
+    self.refineSurfaceCheckBox = qt.QCheckBox()
+    self.refineSurfaceCheckBox.checked = False
+    self.refineSurfaceCheckBox.setToolTip("Recompute the downsampled surface at full resolution in a narrow band around it.")
+    parametersFormLayout.addRow("Refine surface", self.refineSurfaceCheckBox)
+
+    self.triangleBudgetSpinBox = qt.QSpinBox()
+    self.triangleBudgetSpinBox.minimum = 0
+    self.triangleBudgetSpinBox.maximum = 10000000
+    self.triangleBudgetSpinBox.singleStep = 10000
+    self.triangleBudgetSpinBox.specialValueText = "No limit"
+    self.triangleBudgetSpinBox.value = 0
+    self.triangleBudgetSpinBox.setToolTip("Decimate the surface to at most this many triangles.")
+    parametersFormLayout.addRow("Triangle budget", self.triangleBudgetSpinBox)
+
+    self.smoothingRadiusSliderWidget = ctk.ctkSliderWidget()
+    self.smoothingRadiusSliderWidget.singleStep = 5
+    self.smoothingRadiusSliderWidget.minimum = 0
+    self.smoothingRadiusSliderWidget.maximum = 200
+    self.smoothingRadiusSliderWidget.value = 0
+    self.smoothingRadiusSliderWidget.setToolTip("Smooth the surface only within this distance (mm) of the nasion. 0 smooths the whole surface.")
+    parametersFormLayout.addRow("Smoothing radius", self.smoothingRadiusSliderWidget)
+
+    self.diskCacheDirectoryLineEdit = ctk.ctkPathLineEdit()
+    self.diskCacheDirectoryLineEdit.filters = ctk.ctkPathLineEdit.Dirs
+    self.diskCacheDirectoryLineEdit.settingKey = "VentriculostomySurfaceCut/DiskCacheDirectory"
+    self.diskCacheDirectoryLineEdit.setToolTip("Keep the created surfaces in this directory and reuse them in later sessions. Leave empty to disable.")
+    parametersFormLayout.addRow("Surface cache", self.diskCacheDirectoryLineEdit)
+
+    self.numberOfThreadsSpinBox = qt.QSpinBox()
+    self.numberOfThreadsSpinBox.minimum = 0
+    self.numberOfThreadsSpinBox.maximum = multiprocessing.cpu_count()
+    self.numberOfThreadsSpinBox.specialValueText = "Default"
+    self.numberOfThreadsSpinBox.value = 0
+    self.numberOfThreadsSpinBox.setToolTip("Number of threads used by the SimpleITK and VTK filters. This is a setting of the whole Slicer process.")
+    parametersFormLayout.addRow("Threads", self.numberOfThreadsSpinBox)
+
+    self.backgroundCheckBox = qt.QCheckBox()
+    self.backgroundCheckBox.checked = False
+    self.backgroundCheckBox.setToolTip("Create the surface on a worker thread, keeping the application responsive.")
+    parametersFormLayout.addRow("Run in background", self.backgroundCheckBox)
+
+    self.livePreviewCheckBox = qt.QCheckBox()
+    self.livePreviewCheckBox.checked = False
+    self.livePreviewCheckBox.setToolTip("Show a coarse iso-surface of the input while the threshold changes and create the surface in the background once it stops changing.")
+    parametersFormLayout.addRow("Live preview", self.livePreviewCheckBox)
+
+    self.incrementalCutCheckBox = qt.QCheckBox()
+    self.incrementalCutCheckBox.checked = False
+    self.incrementalCutCheckBox.setToolTip("Update the cut surface when the nasion moves, recomputing only the parts that depend on it.")
+    parametersFormLayout.addRow("Follow nasion", self.incrementalCutCheckBox)
+
     #
     # Apply Button
     #
@@ -126,6 +183,15 @@ class VentriculostomySurfaceCutWidget(ScriptedLoadableModuleWidget):
     self.onCreateSurfaceButton.enabled = False
     parametersFormLayout.addRow(self.onCreateSurfaceButton)
 
+    self.createSurfaceProgressBar = qt.QProgressBar()
+    self.createSurfaceProgressBar.visible = False
+    parametersFormLayout.addRow(self.createSurfaceProgressBar)
+
+    self.cancelCreateSurfaceButton = qt.QPushButton("Cancel")
+    self.cancelCreateSurfaceButton.toolTip = "Stop creating the surface. The running filter stops at its next progress update."
+    self.cancelCreateSurfaceButton.visible = False
+    parametersFormLayout.addRow(self.cancelCreateSurfaceButton)
+
     self.onCutSurfaceButton = qt.QPushButton("CutSurface")
     self.onCutSurfaceButton.toolTip = "Cut the surface base on the nasion point."
     self.onCutSurfaceButton.enabled = False
@@ -134,10 +200,33 @@ class VentriculostomySurfaceCutWidget(ScriptedLoadableModuleWidget):
     # connections
     self.onCreateSurfaceButton.connect('clicked(bool)', self.onCreateSurface)
     self.onCutSurfaceButton.connect('clicked(bool)', self.onCutSurface)
+    self.cancelCreateSurfaceButton.connect('clicked(bool)', self.onCancelCreateSurface)
     self.inputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.inputNasionSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
     self.outputSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSelect)
 
+    self.incrementalCutCheckBox.connect("toggled(bool)", self.onSelect)
+    self.imageThresholdSliderWidget.connect("valueChanged(double)", self.onThresholdChanged)
+    self.numberOfThreadsSpinBox.connect("valueChanged(int)", self.onNumberOfThreadsChanged)
+
+    # Preview shortly after the threshold changes, create the surface once it settles
+    self.previewTimer = qt.QTimer()
+    self.previewTimer.setSingleShot(True)
+    self.previewTimer.setInterval(50)
+    self.previewTimer.connect("timeout()", self.onPreviewSurface)
+    self.createSurfaceTimer = qt.QTimer()
+    self.createSurfaceTimer.setSingleShot(True)
+    self.createSurfaceTimer.setInterval(1000)
+    self.createSurfaceTimer.connect("timeout()", self.onCreateSurfaceTimer)
+
+    # Re-cut once the nasion stops moving instead of on every drag event
+    self.observedNasionNode = None
+    self.nasionObserverTags = []
+    self.recutTimer = qt.QTimer()
+    self.recutTimer.setSingleShot(True)
+    self.recutTimer.setInterval(300)
+    self.recutTimer.connect("timeout()", self.onRecutSurface)
+
     self.logic = VentriculostomySurfaceCutLogic()
     # Add vertical spacer
     self.layout.addStretch(1)
@@ -150,6 +239,10 @@ class VentriculostomySurfaceCutWidget(ScriptedLoadableModuleWidget):
     globals()[moduleName] = slicer.util.reloadScriptedModule(moduleName)
 
   def cleanup(self):
+    self.observeNasionNode(None)
+    self.recutTimer.stop()
+    self.previewTimer.stop()
+    self.createSurfaceTimer.stop()
     self.logic.clear()
     self.logic.coronalReferenceCurveManager.clear()
     self.logic.sagittalReferenceCurveManager.clear()
@@ -158,43 +251,89 @@ class VentriculostomySurfaceCutWidget(ScriptedLoadableModuleWidget):
   def onSelect(self):
     self.onCreateSurfaceButton.enabled = self.inputSelector.currentNode() and self.outputSelector.currentNode()
     self.onCutSurfaceButton.enabled = self.inputSelector.currentNode() and self.inputNasionSelector.currentNode() and self.outputSelector.currentNode()
+    self.observeNasionNode(self.inputNasionSelector.currentNode() if self.incrementalCutCheckBox.checked else None)
+
+  def observeNasionNode(self, nasionNode):
+    if nasionNode is self.observedNasionNode:
+      return
+    for observerTag in self.nasionObserverTags:
+      self.observedNasionNode.RemoveObserver(observerTag)
+    self.observedNasionNode = nasionNode
+    self.nasionObserverTags = []
+    if nasionNode:
+      # the second point sets the yaw, so adding or removing points also changes the cut
+      self.nasionObserverTags = [nasionNode.AddObserver(event, self.onNasionModified) for event in
+        [slicer.vtkMRMLMarkupsNode.PointModifiedEvent, slicer.vtkMRMLMarkupsNode.PointAddedEvent, slicer.vtkMRMLMarkupsNode.PointRemovedEvent]]
+
+  def onNasionModified(self, caller=None, event=None):
+    # only follow the nasion once a cut exists
+    if self.logic.boxLabelExtents and self.observedNasionNode.GetNumberOfMarkups():
+      self.recutTimer.start()
+
+  def onRecutSurface(self):
+    if self.onCutSurfaceButton.enabled:
+      self.logic.recutSurface(self.inputNasionSelector.currentNode(), self.outputSelector.currentNode(), 100.0, 30.0)
+
+  def onNumberOfThreadsChanged(self, numberOfThreads):
+    self.logic.setNumberOfThreads(numberOfThreads)
+
+  def onThresholdChanged(self, value):
+    # the button is disabled during a background run, the changes made meanwhile are created once it finishes
+    if self.livePreviewCheckBox.checked and self.inputSelector.currentNode() and self.outputSelector.currentNode():
+      self.previewTimer.start()
+      self.createSurfaceTimer.start()
+
+  def onPreviewSurface(self):
+    if self.inputSelector.currentNode() and self.outputSelector.currentNode():
+      self.logic.createPreviewModel(self.inputSelector.currentNode(), self.outputSelector.currentNode(), self.imageThresholdSliderWidget.value)
 
   def onCreateSurface(self):
+    self.createSurface(self.backgroundCheckBox.checked)
+
+  def onCreateSurfaceTimer(self):
+    # the live preview keeps the slider responsive, so its full run is always in the background
+    if self.inputSelector.currentNode() and self.outputSelector.currentNode():
+      self.createSurface(True)
+
+  def createSurface(self, inBackground):
+    self.createSurfaceTimer.stop()
     imageThreshold = self.imageThresholdSliderWidget.value
-    self.logic.createModel(self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold)
+    self.logic.samplingFactor = int(self.samplingFactorComboBox.currentText)
+    self.logic.refineCoarseSurface = self.refineSurfaceCheckBox.checked
+    self.logic.diskCacheDirectory = self.diskCacheDirectoryLineEdit.currentPath or None
+    self.logic.surfaceTriangleBudget = self.triangleBudgetSpinBox.value
+    self.logic.setSmoothingRegion(self.inputNasionSelector.currentNode(), self.smoothingRadiusSliderWidget.value)
+    if not inBackground:
+      self.logic.createModel(self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold)
+      return
+    if self.logic.createModelAsync(self.inputSelector.currentNode(), self.outputSelector.currentNode(), imageThreshold,
+        progressCallback=self.onCreateSurfaceProgress, finishedCallback=self.onCreateSurfaceFinished):
+      self.onCreateSurfaceButton.enabled = False
+      self.createSurfaceProgressBar.value = 0
+      self.createSurfaceProgressBar.visible = True
+      self.cancelCreateSurfaceButton.visible = True
+    else:
+      # the threshold changed while the surface was being created
+      self.createSurfaceTimer.start()
+
+  def onCreateSurfaceProgress(self, stageName, fraction):
+    self.createSurfaceProgressBar.format = stageName + " %p%"
+    self.createSurfaceProgressBar.value = int(100 * fraction)
+
+  def onCreateSurfaceFinished(self, completed):
+    self.createSurfaceProgressBar.visible = False
+    self.cancelCreateSurfaceButton.visible = False
+    self.onSelect()
+
+  def onCancelCreateSurface(self):
+    self.logic.cancelModelAsync()
 
   def onCutSurface(self):
-    self.logic.generateBaseLabel(self.logic.holefilledImageNode, self.inputNasionSelector.currentNode(), 100.0, 30.0, self.outputSelector.currentNode())
-    self.exportLabelMapToModel()
-    self.logic.cutModel()
-    pass
-  
-  def exportLabelMapToModel(self):
-    self.activeSegmentSelector.removeCurrentNode()
-    self.activeSegmentSelector.addNode()
-    slicer.app.processEvents()
-    segNode = self.activeSegmentSelector.currentNode()
-    print segNode.GetID()
-    segNode.CreateDefaultDisplayNodes()    
-    self.importRadioButton.click()
-    self.labelMapRadioButton.click()
-    imageFilter = vtk.vtkImageMathematics()
-    imageFilter.SetInput1Data(self.logic.guideVolumeNode.GetImageData())
-    imageFilter.SetInput2Data(self.logic.baseVolumeNode.GetImageData())
-    imageFilter.SetOperationToMax()  # performed inverse operation on the
-    imageFilter.Update()
-    self.logic.guideVolumeNode.SetAndObserveImageData(imageFilter.GetOutput())
-    self.labelMapSelector.setCurrentNode(self.logic.guideVolumeNode)
-    self.portPushButton.click()
-    self.logic.sagittalReferenceCurveManager.setModelOpacity(0.0)
-    self.logic.coronalReferenceCurveManager.setModelOpacity(0.0)
-    self.exportRadioButton.click()
-    self.modelsRadioButton.click()
-    self.portPushButton.click()
-    slicer.app.processEvents()
-    modelName = segNode.GetSegmentation().GetNthSegment(0).GetName()
-    self.logic.baseModel = slicer.mrmlScene.GetNodesByClassByName("vtkMRMLModelNode", modelName).GetItemAsObject(0)
-    pass  
+    if self.incrementalCutCheckBox.checked:
+      self.logic.recutSurface(self.inputNasionSelector.currentNode(), self.outputSelector.currentNode(), 100.0, 30.0)
+    else:
+      self.logic.cutSurface(self.inputNasionSelector.currentNode(), self.outputSelector.currentNode(), 100.0, 30.0)
+
 #
 # VentriculostomySurfaceCutLogic
 #
@@ -208,6 +347,10 @@ class CurveManagerSurfaceCut():
         "Error: Could not find extension CurveMaker. Open Slicer Extension Manager and install "
         "CurveMaker.", "Missing Extension")
     self.cmLogic = CurveMaker.CurveMakerLogic()
+    # Route every CurveMaker rebuild, including the ones of its own source observer,
+    # through onCurveMakerUpdate so that they are counted and can be suspended
+    self.rebuildCurve = self.cmLogic.updateCurve
+    self.cmLogic.updateCurve = self.onCurveMakerUpdate
     self.curveFiducials = None
     self._curveModel = None
     self.opacity = 1
@@ -217,6 +360,10 @@ class CurveManagerSurfaceCut():
     self.step = 1
     self.tagEventExternal = None
     self.externalHandler = None
+    # Number of curve rebuilds, for tests and profiling
+    self.curveRebuildCount = 0
+    # Skip the curve rebuilds while the fiducials are being replaced
+    self.suspendCurveUpdate = False
 
     self.sliceID = "vtkMRMLSliceNodeRed"
     modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
@@ -307,25 +454,65 @@ class CurveManagerSurfaceCut():
     self.externalHandler = None
     self.tagEventExternal = None
 
-  def onLineSourceUpdated(self, caller=None, event=None):
+  def updateCurve(self):
 
     self.cmLogic.updateCurve()
 
+  def onCurveMakerUpdate(self):
+
+    if self.suspendCurveUpdate:
+      return
+    self.curveRebuildCount += 1
+    self.rebuildCurve()
+
+  def onLineSourceUpdated(self, caller=None, event=None):
+
+    if self.suspendCurveUpdate:
+      return
+    self.updateCurve()
+
     # Make slice intersetion visible
     if self._curveModel:
       dnode = self._curveModel.GetDisplayNode()
       if dnode:
         dnode.SetSliceIntersectionVisibility(1)
 
+  def createCurveFiducials(self):
+
+    self.curveFiducials = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
+    self.curveFiducials.SetName(self.curveName)
+    slicer.mrmlScene.AddNode(self.curveFiducials)
+    dnode = self.curveFiducials.GetMarkupsDisplayNode()
+    if dnode:
+      dnode.SetSelectedColor(self.cmLogic.ModelColor)
+
+  def setCurvePoints(self, pointArray, interpolationMethod=1):
+    """Replace the curve fiducials with the rows of an N x 3 array.
+    The fiducials are added in a single modify block with the curve rebuilds
+    suspended, and the curve is rebuilt exactly once afterwards.
+    """
+    if self.curveFiducials == None:
+      self.createCurveFiducials()
+    self.cmLogic.DestinationNode = self._curveModel
+    self.cmLogic.SourceNode = self.curveFiducials
+    self.suspendCurveUpdate = True
+    wasModifying = self.curveFiducials.StartModify()
+    self.curveFiducials.RemoveAllMarkups()
+    self.cmLogic.CurvePoly = vtk.vtkPolyData()  ## For CurveMaker bug
+    self.cmLogic.setInterpolationMethod(interpolationMethod)
+    self.cmLogic.setTubeRadius(self.tubeRadius)
+    for pos in pointArray:
+      self.curveFiducials.AddFiducial(pos[0], pos[1], pos[2])
+    self.curveFiducials.EndModify(wasModifying)
+    # CurveMaker observes the fiducials only from here on, the batch above did not reach it
+    self.cmLogic.enableAutomaticUpdate(1)
+    self.suspendCurveUpdate = False
+    self.updateCurve()
+
   def startEditLine(self, initPoint=None):
 
     if self.curveFiducials == None:
-      self.curveFiducials = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
-      self.curveFiducials.SetName(self.curveName)
-      slicer.mrmlScene.AddNode(self.curveFiducials)
-      dnode = self.curveFiducials.GetMarkupsDisplayNode()
-      if dnode:
-        dnode.SetSelectedColor(self.cmLogic.ModelColor)
+      self.createCurveFiducials()
     if initPoint != None:
       self.curveFiducials.AddFiducial(initPoint[0], initPoint[1], initPoint[2])
       self.moveSliceToLine()
@@ -348,7 +535,7 @@ class CurveManagerSurfaceCut():
     self.cmLogic.DestinationNode = self._curveModel
     self.cmLogic.SourceNode = self.curveFiducials
     self.cmLogic.SourceNode.SetAttribute('CurveMaker.CurveModel', self.cmLogic.DestinationNode.GetID())
-    self.cmLogic.updateCurve()
+    self.updateCurve()
 
     self.cmLogic.CurvePoly = vtk.vtkPolyData()  ## For CurveMaker bug
     self.cmLogic.enableAutomaticUpdate(1)
@@ -369,7 +556,7 @@ class CurveManagerSurfaceCut():
       # To trigger the initializaton, when the user clear the trajectory and restart the planning,
       # the last point of the coronal reference line should be added to the trajectory
 
-    self.cmLogic.updateCurve()
+    self.updateCurve()
 
     if self._curveModel:
       pdata = self._curveModel.GetPolyData()
@@ -449,6 +636,28 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  defaultPipelineParameters = {
+    "threshold": 20.0,
+    "sagittalReferenceLength": 100.0,
+    "coronalReferenceLength": 30.0,
+    "outputModel": None,
+    "pointOrderingMethod": "distance",
+    "closingMethod": "kernel",
+    "samplingFactor": 1,
+    "refineCoarseSurface": False,
+    "surfaceExtractionMethod": "flyingedges",
+    "diskCacheDirectory": None,
+    "numberOfThreads": 0,
+    "surfaceTriangleBudget": 0,
+    "smoothingRadius": 0.0,
+  }
+
+  # Names of the files written in the disk cache directory, the only ones ever evicted
+  diskCacheFilePattern = re.compile(r"^([0-9a-f]{40})_(holefilled\.nrrd|subtracted\.nrrd|skin\.vtp)$")
+
+  # SimpleITK and vtkMultiThreader global defaults found before the first setNumberOfThreads call
+  defaultNumberOfThreads = None
+
   def __init__(self):
     self.sagittalReferenceCurveManager = CurveManagerSurfaceCut()
     self.sagittalReferenceCurveManager.setName("SR1")
@@ -464,7 +673,10 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
     self.subtractedModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
     self.subtractedModel.SetName("Not For Use")
     slicer.mrmlScene.AddNode(self.subtractedModel)
-    self.baseModel = None
+    self.baseModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    self.baseModel.SetName("BaseModel")
+    slicer.mrmlScene.AddNode(self.baseModel)
+    self.baseModel.CreateDefaultDisplayNodes()
     self.rightSide = 1
     self.middlePart = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
     self.middlePart.SetName("MiddlePart")
@@ -482,13 +694,65 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
     self.trueSagittalPlane = None
     self.useLeftHemisphere = False
     self.sagittalYawAngle = 0.0
+    # "distance" sorts the cutter points by distance to the reference point,
+    # "contour" walks the stripped cutter polyline from the reference point
+    self.pointOrderingMethod = "distance"
     self.holefilledImageNode = None
+    self.subtractedImageNode = None
+    # Run the morphology only around the thresholded head instead of the whole volume
+    self.cropBeforeMorphology = True
+    # Run the morphology on a volume downsampled by this factor (1, 2 or 4)
+    self.samplingFactor = 1
+    self.refineCoarseSurface = False
+    # "flyingedges" extracts the surface in process, "cli" runs the Grayscale Model Maker module
+    self.surfaceExtractionMethod = "flyingedges"
+    # "singlepass" splits the base model into both parts at once, "clip" clips it twice
+    self.splitMethod = "singlepass"
+    # Points of the base model within this distance of a cutting plane, in mm, are on the plane
+    self.splitTolerance = 1e-6
+    # Decimate the skin surface to at most this many triangles, 0 keeps all of them
+    self.surfaceTriangleBudget = 0
+    # Smooth the skin surface only within smoothingRadius mm of smoothingCenter, when both are set
+    self.smoothingCenter = None
+    self.smoothingRadius = 0.0
+    # Skin surface before smoothing and the getSurfaceSettings of the current skin surface,
+    # so that moving the smoothing region only redoes the smoothing
+    self.unsmoothedSkinPolyData = None
+    self.skinSurfaceSettings = None
+    # "flyingedges" converts the merged label to the base model directly, "segmentation"
+    # through a segmentation node
+    self.labelConversionMethod = "flyingedges"
+    # "analytic" labels the base and guide boxes directly, "stencil" rasterizes cube models
+    self.boxLabelMethod = "analytic"
+    self.baseBoxDimension = [130, 50, 50]
+    # IJK extents of the analytic base and guide boxes of the last cut, updated by recutSurface
+    self.boxLabelExtents = []
     self.baseVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLLabelMapVolumeNode")
     self.baseVolumeNode.SetName("Base")
     slicer.mrmlScene.AddNode(self.baseVolumeNode)
     self.guideVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLLabelMapVolumeNode")
     self.guideVolumeNode.SetName("Guide")
     slicer.mrmlScene.AddNode(self.guideVolumeNode)
+    self.skinModel = None
+    # createModel results by input volume, geometry and parameters, least recently used first
+    self.modelCache = collections.OrderedDict()
+    self.modelCacheMemoryLimit = 1024 * 1024 # in KiB, as reported by GetActualMemorySize
+    self.modelCacheHits = 0
+    self.modelCacheMisses = 0
+    # Persistent createModel cache shared between sessions, disabled when None
+    self.diskCacheDirectory = None
+    self.diskCacheSizeLimit = 2 * 1024 * 1024 * 1024 # in bytes
+    self.diskCacheHits = 0
+    # Input of the threshold preview, downsampled to at most previewMaximumDimension voxels per axis
+    self.previewMaximumDimension = 128
+    self.previewImageKey = None
+    self.previewImageData = None
+    # Threads of the SimpleITK and VTK filters, 0 for the process defaults
+    self.numberOfThreads = 0
+    # createModelAsync worker thread
+    self.modelWorker = None
+    self.modelWorkerTimer = None
+    self.modelWorkerCancelEvent = threading.Event()
 
   def clear(self):
     if self.leftPart:
@@ -499,16 +763,48 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
       slicer.mrmlScene.RemoveNode(self.middlePart)
     if self.subtractedModel:
       slicer.mrmlScene.RemoveNode(self.subtractedModel)
+    if self.baseModel:
+      slicer.mrmlScene.RemoveNode(self.baseModel)
     if self.baseVolumeNode:
       slicer.mrmlScene.RemoveNode(self.baseVolumeNode)
     if self.guideVolumeNode:
       slicer.mrmlScene.RemoveNode(self.guideVolumeNode)
+    if self.skinModel:
+      slicer.mrmlScene.RemoveNode(self.skinModel)
+    self.cancelModelAsync()
+    if self.modelWorkerTimer:
+      self.modelWorkerTimer.stop()
+    self.clearModelCache()
     self.leftPart = None
     self.rightPart = None
     self.middlePart = None
     self.subtractedModel = None
+    self.baseModel = None
     self.baseVolumeNode = None
     self.guideVolumeNode = None
+    self.skinModel = None
+
+  def setNumberOfThreads(self, numberOfThreads):
+    """Set the number of threads of every SimpleITK filter, VTK threaded image filter and
+    VTK SMP filter (flying edges, ...) created afterwards, in the whole process.
+    0 restores the defaults found before the first call. The SMP filters may keep their
+    first thread count: vtkSMPTools.Initialize only takes effect once on the TBB and OpenMP backends.
+    """
+    self.numberOfThreads = int(numberOfThreads)
+    if VentriculostomySurfaceCutLogic.defaultNumberOfThreads is None:
+      if self.numberOfThreads <= 0:
+        return
+      VentriculostomySurfaceCutLogic.defaultNumberOfThreads = (sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(),
+        vtk.vtkMultiThreader.GetGlobalDefaultNumberOfThreads())
+    if self.numberOfThreads > 0:
+      sitkThreadCount = vtkThreadCount = smpThreadCount = self.numberOfThreads
+    else:
+      sitkThreadCount, vtkThreadCount = VentriculostomySurfaceCutLogic.defaultNumberOfThreads
+      smpThreadCount = 0
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(sitkThreadCount)
+    vtk.vtkMultiThreader.SetGlobalDefaultNumberOfThreads(vtkThreadCount)
+    if hasattr(vtk, "vtkSMPTools"):
+      vtk.vtkSMPTools.Initialize(smpThreadCount)
 
   def hasImageData(self,volumeNode):
     """This is an example logic method that
@@ -537,80 +833,1119 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def createModel(self, ventricleVolume, outputModelNode, thresholdValue):
+  def runPipeline(self, inputVolume, nasionNode, params=None):
+    """Run the CreateSurface and CutSurface steps without the widget, e.g. from
+    Slicer --no-main-window --python-script. Keys missing from params are taken
+    from defaultPipelineParameters. Returns the LeftPart, RightPart and MiddlePart
+    model nodes, or None if the inputs are not valid.
+    """
+    parameters = dict(self.defaultPipelineParameters)
+    if params:
+      parameters.update(params)
+    if not self.hasImageData(inputVolume):
+      logging.error('runPipeline failed: input volume has no image data')
+      return None
+    if not nasionNode or not nasionNode.GetNumberOfFiducials():
+      logging.error('runPipeline failed: nasion node has no fiducial')
+      return None
+    outputModelNode = parameters["outputModel"]
+    if outputModelNode is None:
+      if self.skinModel is None:
+        self.skinModel = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+        self.skinModel.SetName("SkinModel")
+        slicer.mrmlScene.AddNode(self.skinModel)
+      outputModelNode = self.skinModel
+    self.pointOrderingMethod = parameters["pointOrderingMethod"]
+    self.samplingFactor = parameters["samplingFactor"]
+    self.refineCoarseSurface = parameters["refineCoarseSurface"]
+    self.surfaceExtractionMethod = parameters["surfaceExtractionMethod"]
+    self.diskCacheDirectory = parameters["diskCacheDirectory"]
+    if parameters["numberOfThreads"]:
+      # only touch the process wide thread settings when asked to
+      self.setNumberOfThreads(parameters["numberOfThreads"])
+    self.surfaceTriangleBudget = parameters["surfaceTriangleBudget"]
+    self.setSmoothingRegion(nasionNode, parameters["smoothingRadius"])
+    self.createModel(inputVolume, outputModelNode, parameters["threshold"], parameters["closingMethod"])
+    self.cutSurface(nasionNode, outputModelNode, parameters["sagittalReferenceLength"], parameters["coronalReferenceLength"])
+    return self.leftPart, self.rightPart, self.middlePart
+
+  def cutSurface(self, nasionNode, outputModelNode, sagittalReferenceLength, coronalReferenceLength):
+    self.followSmoothingRegion(nasionNode, outputModelNode)
+    self.generateBaseLabel(self.holefilledImageNode, nasionNode, sagittalReferenceLength, coronalReferenceLength, outputModelNode)
+    self.exportLabelMapToModel()
+    self.cutModel()
+
+  def recutSurface(self, nasionNode, outputModelNode, sagittalReferenceLength, coronalReferenceLength):
+    """Update the last cutSurface result after the nasion moved. The sagittal plane and
+    the reference curves are recomputed, the labels are only rewritten inside the previous
+    and new box extents and only the labeled extent is converted to the base model.
+    Falls back to cutSurface when there is no analytic cut to update.
+    """
+    self.followSmoothingRegion(nasionNode, outputModelNode)
+    if not self.boxLabelExtents or self.boxLabelMethod != "analytic" or not nasionNode.GetNumberOfMarkups():
+      self.cutSurface(nasionNode, outputModelNode, sagittalReferenceLength, coronalReferenceLength)
+      return
+    baseImageData = self.baseVolumeNode.GetImageData()
+    mergedImageData = self.guideVolumeNode.GetImageData()
+    self.createTrueSagittalPlane(nasionNode)
+    self.generateKocherNav(outputModelNode, nasionNode, sagittalReferenceLength, coronalReferenceLength)
+    posNasion = numpy.array([0.0, 0.0, 0.0])
+    nasionNode.GetNthFiducialPosition(0, posNasion)
+    centerPos, guidanceDimension = self.getGuidanceBoundary()
+    for extent in self.boxLabelExtents:
+      self.getExtentArray(baseImageData, extent)[:] = 0
+      self.getExtentArray(mergedImageData, extent)[:] = 0
+    self.boxLabelExtents = []
+    self.composeBoxLabels(self.holefilledImageNode, posNasion, centerPos, guidanceDimension)
+    if not self.boxLabelExtents:
+      self.baseModel.SetAndObservePolyData(vtk.vtkPolyData())
+    else:
+      self.convertLabelToBaseModel(self.getBoxLabelExtent())
+    self.cutModel()
+
+  def followSmoothingRegion(self, nasionNode, outputModelNode):
+    """Move the smoothed region of the skin surface to the current nasion, if the smoothing
+    is limited to a region.
+    """
+    if self.smoothingRadius > 0 and self.holefilledImageNode:
+      self.setSmoothingRegion(nasionNode, self.smoothingRadius)
+      self.updateSkinSurface(outputModelNode)
+
+  def getBoxLabelExtent(self):
+    """Extent of the merged label that can be non-zero: the union of the base and guide box
+    extents, with one voxel of margin to keep the background around the label.
+    """
+    imageExtent = self.guideVolumeNode.GetImageData().GetExtent()
+    labelExtent = []
+    for axis in range(3):
+      labelExtent.append(max(imageExtent[2 * axis], min(extent[2 * axis] for extent in self.boxLabelExtents) - 1))
+      labelExtent.append(min(imageExtent[2 * axis + 1], max(extent[2 * axis + 1] for extent in self.boxLabelExtents) + 1))
+    return labelExtent
+
+  def getExtentArray(self, imageData, extent):
+    """NumPy view, in k, j, i order, of the voxels of imageData within extent.
+    """
+    imageExtent = imageData.GetExtent()
+    dimensions = imageData.GetDimensions()
+    voxelArray = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[::-1])
+    return voxelArray[extent[4] - imageExtent[4]:extent[5] - imageExtent[4] + 1,
+                      extent[2] - imageExtent[2]:extent[3] - imageExtent[2] + 1,
+                      extent[0] - imageExtent[0]:extent[1] - imageExtent[0] + 1]
+
+  def exportLabelMapToModel(self):
+    """Convert the merged guide and base label to the closed surface baseModel. The analytic
+    boxes are already merged into guideVolumeNode by generateBaseLabel, the stencil labels
+    are merged here.
+    """
+    if self.boxLabelMethod == "stencil":
+      imageFilter = vtk.vtkImageMathematics()
+      imageFilter.SetInput1Data(self.guideVolumeNode.GetImageData())
+      imageFilter.SetInput2Data(self.baseVolumeNode.GetImageData())
+      imageFilter.SetOperationToMax()
+      imageFilter.Update()
+      self.guideVolumeNode.SetAndObserveImageData(imageFilter.GetOutput())
+    # with analytic boxes only their extents can be labeled, so the rest of the head is skipped
+    self.convertLabelToBaseModel(self.getBoxLabelExtent() if self.boxLabelExtents else None)
+
+  def convertLabelToBaseModel(self, labelExtent=None):
+    """Convert the merged label of guideVolumeNode, or only its labelExtent, to the closed
+    surface baseModel. By default the surface is extracted directly from the label;
+    labelConversionMethod "segmentation" goes through a segmentation node instead.
+    """
+    self.sagittalReferenceCurveManager.setModelOpacity(0.0)
+    self.coronalReferenceCurveManager.setModelOpacity(0.0)
+    if self.labelConversionMethod != "segmentation":
+      self.baseModel.SetAndObservePolyData(self.labelToClosedSurface(self.guideVolumeNode, labelExtent))
+      return
+    labelVolumeNode = self.guideVolumeNode
+    if labelExtent is not None:
+      extractFilter = vtk.vtkExtractVOI()
+      extractFilter.SetInputData(self.guideVolumeNode.GetImageData())
+      extractFilter.SetVOI(labelExtent)
+      changeInformation = vtk.vtkImageChangeInformation()
+      changeInformation.SetInputConnection(extractFilter.GetOutputPort())
+      changeInformation.SetOutputExtentStart(0, 0, 0)
+      changeInformation.Update()
+      ijkToRas = vtk.vtkMatrix4x4()
+      self.guideVolumeNode.GetIJKToRASMatrix(ijkToRas)
+      labelOrigin = ijkToRas.MultiplyPoint([labelExtent[0], labelExtent[2], labelExtent[4], 1.0])
+      for row in range(3):
+        ijkToRas.SetElement(row, 3, labelOrigin[row])
+      labelVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLLabelMapVolumeNode")
+      slicer.mrmlScene.AddNode(labelVolumeNode)
+      labelVolumeNode.SetIJKToRASMatrix(ijkToRas)
+      labelVolumeNode.SetAndObserveImageData(changeInformation.GetOutput())
+    segmentationNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLSegmentationNode")
+    slicer.mrmlScene.AddNode(segmentationNode)
+    slicer.vtkSlicerSegmentationsModuleLogic.ImportLabelmapToSegmentationNode(labelVolumeNode, segmentationNode)
+    segmentation = segmentationNode.GetSegmentation()
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    segmentation.CreateRepresentation(closedSurfaceName)
+    polyData = vtk.vtkPolyData()
+    if segmentation.GetNumberOfSegments():
+      polyData.DeepCopy(segmentation.GetNthSegment(0).GetRepresentation(closedSurfaceName))
+    self.baseModel.SetAndObservePolyData(polyData)
+    slicer.mrmlScene.RemoveNode(segmentationNode)
+    if labelVolumeNode is not self.guideVolumeNode:
+      slicer.mrmlScene.RemoveNode(labelVolumeNode)
+
+  def getNonZeroExtent(self, imageData):
+    """Smallest extent holding all the non-zero voxels of imageData, or None if there are none.
+    """
+    imageExtent = imageData.GetExtent()
+    voxelArray = self.getExtentArray(imageData, imageExtent)
+    nonZeroExtent = []
+    for axis, otherAxes in [(2, (0, 1)), (1, (0, 2)), (0, (1, 2))]:
+      nonZeroIndices = numpy.flatnonzero(voxelArray.any(axis=otherAxes))
+      if not len(nonZeroIndices):
+        return None
+      nonZeroExtent += [int(imageExtent[2 * (2 - axis)] + nonZeroIndices[0]), int(imageExtent[2 * (2 - axis)] + nonZeroIndices[-1])]
+    return nonZeroExtent
+
+  def labelToClosedSurface(self, labelVolumeNode, labelExtent=None):
+    """Closed surface of the non-zero voxels of a 0/1 label, in RAS, computed with discrete
+    flying edges over labelExtent (by default the non-zero extent of the label) padded with
+    one voxel of background. Smoothing and normals follow the default binary labelmap to
+    closed surface conversion of the segmentations.
+    """
+    labelImageData = labelVolumeNode.GetImageData()
+    if labelExtent is None:
+      labelExtent = self.getNonZeroExtent(labelImageData)
+      if labelExtent is None:
+        return vtk.vtkPolyData()
+    extractFilter = vtk.vtkExtractVOI()
+    extractFilter.SetInputData(labelImageData)
+    extractFilter.SetVOI(labelExtent)
+    padFilter = vtk.vtkImageConstantPad()
+    padFilter.SetInputConnection(extractFilter.GetOutputPort())
+    padFilter.SetOutputWholeExtent([labelExtent[index] + (1 if index % 2 else -1) for index in range(6)])
+    padFilter.SetConstant(0)
+    if hasattr(vtk, "vtkDiscreteFlyingEdges3D"):
+      surfaceFilter = vtk.vtkDiscreteFlyingEdges3D()
+    else:
+      surfaceFilter = vtk.vtkDiscreteMarchingCubes()
+    surfaceFilter.SetInputConnection(padFilter.GetOutputPort())
+    surfaceFilter.SetValue(0, 1)
+    surfaceFilter.ComputeNormalsOff()
+    surfaceFilter.ComputeGradientsOff()
+    surfaceFilter.ComputeScalarsOff()
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(surfaceFilter.GetOutputPort())
+    smoother.SetNumberOfIterations(20)
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.SetFeatureAngle(120.0)
+    smoother.SetPassBand(0.01)
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    ijkToRas = vtk.vtkMatrix4x4()
+    labelVolumeNode.GetIJKToRASMatrix(ijkToRas)
+    ijkToRasTransform = vtk.vtkTransform()
+    ijkToRasTransform.SetMatrix(ijkToRas)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(ijkToRasTransform)
+    transformFilter.SetInputConnection(smoother.GetOutputPort())
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformFilter.GetOutputPort())
+    normals.ComputePointNormalsOn()
+    normals.SplittingOff()
+    normals.ConsistencyOn()
+    if ijkToRas.Determinant() < 0:
+      normals.FlipNormalsOn()
+    normals.Update()
+    return normals.GetOutput()
+
+  def createModel(self, ventricleVolume, outputModelNode, thresholdValue, closingMethod="kernel"):
+    """Build the closed head mask and the skin surface from the input volume.
+    closingMethod selects the morphology engine: "kernel" uses ball structuring
+    elements, "distance" thresholds Maurer distance maps, whose cost does not
+    depend on the radius.
+    With samplingFactor 2 or 4 the morphology runs on a smoothed, downsampled volume
+    with the kernel radii scaled to keep their size in mm. If refineCoarseSurface is
+    set, the mask is then recomputed at full resolution in a narrow band around the
+    coarse surface.
+    """
+    task = self.startModelTask(ventricleVolume, outputModelNode, thresholdValue, closingMethod)
+    if task is None:
+      return
+    self.modelWorkerCancelEvent.clear()
+    holefilledImage, subtractedImage = self.computeModelMasks(task)
+    self.finishModelTask(task, holefilledImage, subtractedImage)
+    return
+
+  def createModelAsync(self, ventricleVolume, outputModelNode, thresholdValue, closingMethod="kernel",
+      progressCallback=None, finishedCallback=None):
+    """Same as createModel, but the SimpleITK morphology runs on a worker thread while the
+    main thread keeps processing events. progressCallback(stageName, fraction) and
+    finishedCallback(completed) are called on the main thread, which also does all the
+    scene updates, and always after createModelAsync returned, even on a cache hit.
+    Returns False if a computation is already running.
+    """
+    if self.modelWorker is not None and self.modelWorker.is_alive():
+      return False
+    task = self.startModelTask(ventricleVolume, outputModelNode, thresholdValue, closingMethod)
+    if task is None:
+      if finishedCallback:
+        # let the caller set up its busy state first
+        qt.QTimer.singleShot(0, lambda: finishedCallback(True))
+      return True
+    self.modelWorkerCancelEvent.clear()
+    messages = queue.Queue()
+
+    def stageCallback(stageName, fraction):
+      messages.put(("progress", stageName, fraction))
+      return not self.modelWorkerCancelEvent.is_set()
+
+    def computeMasks():
+      try:
+        masks = self.computeModelMasks(task, stageCallback)
+      except Exception as error:
+        # a cancelled filter is aborted with an exception
+        if not self.modelWorkerCancelEvent.is_set():
+          logging.error('createModel failed: %s' % error)
+        masks = None
+      messages.put(("finished", masks))
+
+    def processMessages():
+      while not messages.empty():
+        message = messages.get()
+        if message[0] == "progress":
+          if progressCallback:
+            progressCallback(message[1], message[2])
+          continue
+        self.modelWorkerTimer.stop()
+        self.modelWorker = None
+        completed = message[1] is not None and not self.modelWorkerCancelEvent.is_set()
+        if completed:
+          if progressCallback:
+            progressCallback("Extracting the surface", 0.9)
+          self.finishModelTask(task, message[1][0], message[1][1])
+        if finishedCallback:
+          finishedCallback(completed)
+        return
+
+    self.modelWorkerTimer = qt.QTimer()
+    self.modelWorkerTimer.setInterval(100)
+    self.modelWorkerTimer.connect("timeout()", processMessages)
+    self.modelWorker = threading.Thread(target=computeMasks)
+    self.modelWorker.daemon = True
+    self.modelWorker.start()
+    self.modelWorkerTimer.start()
+    return True
+
+  def cancelModelAsync(self):
+    """Stop the createModelAsync computation: the running SimpleITK filter is aborted at its
+    next progress event, the other steps at their end.
+    """
+    self.modelWorkerCancelEvent.set()
+
+  def startModelTask(self, ventricleVolume, outputModelNode, thresholdValue, closingMethod):
+    """Load the createModel result from the memory cache, or read the inputs of the mask
+    computation from the scene. Returns None on a cache hit, otherwise the task that
+    computeModelMasks and finishModelTask complete. The disk cache is looked up by
+    computeModelMasks, so that hashing the input does not block the main thread.
+    """
+    # the labels of the last cut belong to the previous surface
+    self.boxLabelExtents = []
+    cacheKey = self.getModelCacheKey(ventricleVolume, thresholdValue, closingMethod)
+    cacheEntry = self.modelCache.pop(cacheKey, None)
+    if cacheEntry is not None:
+      self.modelCacheHits += 1
+      self.modelCache[cacheKey] = cacheEntry
+      self.holefilledImageNode = cacheEntry["holefilledImageNode"]
+      self.subtractedImageNode = cacheEntry["subtractedImageNode"]
+      self.unsmoothedSkinPolyData = cacheEntry["unsmoothedPolyData"]
+      self.skinSurfaceSettings = cacheEntry["surfaceSettings"]
+      self.setSkinModelDisplay(outputModelNode)
+      polyData = vtk.vtkPolyData()
+      polyData.ShallowCopy(cacheEntry["polyData"])
+      outputModelNode.SetAndObservePolyData(polyData)
+      self.subtractedModel.SetDisplayVisibility(False)
+      # the masks do not depend on the surface settings, only the surface may need an update
+      if self.skinSurfaceSettings != self.getSurfaceSettings():
+        self.updateSkinSurface(outputModelNode)
+        self.cacheModelResult(cacheKey, outputModelNode)
+      return None
+    self.modelCacheMisses += 1
+    task = {"cacheKey": cacheKey, "diskCacheDirectory": self.diskCacheDirectory, "diskCacheKey": None,
+      "diskCacheSurface": None, "outputModelNode": outputModelNode,
+      "thresholdValue": thresholdValue, "closingMethod": closingMethod, "padding": [10, 10, 10],
+      "closingRadius": [10, 10, 6], "samplingFactor": int(self.samplingFactor),
+      "refineCoarseSurface": self.refineCoarseSurface, "sourceImage": None, "thresholdImage": None}
+    if task["diskCacheDirectory"]:
+      ijkToRas = vtk.vtkMatrix4x4()
+      ventricleVolume.GetIJKToRASMatrix(ijkToRas)
+      task["voxelArray"] = slicer.util.arrayFromVolume(ventricleVolume)
+      task["ijkToRas"] = [round(ijkToRas.GetElement(row, column), 6) for row in range(3) for column in range(4)]
+    if task["samplingFactor"] > 1:
+      task["sourceImage"] = self.imageFromVolume(ventricleVolume)
+    if task["samplingFactor"] == 1 or task["refineCoarseSurface"]:
+      task["thresholdImage"] = self.thresholdVolumeToImage(ventricleVolume, thresholdValue)
+    return task
+
+  def computeModelMasks(self, task, stageCallback=None):
+    """Compute the holefilled and subtracted masks of a task without touching the scene,
+    so that it can run on a worker thread. The masks and the skin surface are read from
+    the disk cache when it holds them. stageCallback(stageName, fraction) is called
+    before each stage; if it returns False the computation stops and None is returned.
+    """
+    def startStage(stageName, fraction):
+      return stageCallback is None or stageCallback(stageName, fraction) is not False
+
+    padding = task["padding"]
+    closingRadius = task["closingRadius"]
+    closingMethod = task["closingMethod"]
+    samplingFactor = task["samplingFactor"]
+    if task["diskCacheDirectory"]:
+      if not startStage("Reading the disk cache", 0.0):
+        return None
+      task["diskCacheKey"] = self.getDiskCacheKey(task)
+      diskCacheEntry = self.readDiskCacheEntry(task["diskCacheDirectory"], task["diskCacheKey"])
+      if diskCacheEntry is not None:
+        task["diskCacheSurface"] = diskCacheEntry[2]
+        return diskCacheEntry[:2]
+    if not startStage("Thresholding", 0.0):
+      return None
+    if samplingFactor > 1:
+      resampledImage = self.downsampleImage(task["sourceImage"], samplingFactor)
+      morphologyPadding = [int(math.ceil(float(pad) / samplingFactor)) for pad in padding]
+      morphologyRadius = [max(int(round(float(radius) / samplingFactor)), 1) for radius in closingRadius]
+      thresholdFilter = sitk.BinaryThresholdImageFilter()
+      thresholdFilter.SetLowerThreshold(task["thresholdValue"])
+      thresholdFilter.SetUpperThreshold(10000)
+      thresholdFilter.SetInsideValue(1)
+      thresholdFilter.SetOutsideValue(0)
+      thresholdImage = thresholdFilter.Execute(resampledImage)
+    else:
+      morphologyPadding = padding
+      morphologyRadius = closingRadius
+      thresholdImage = task["thresholdImage"]
+    if not startStage("Closing and filling holes", 0.1):
+      return None
+    holefilledImage, subtractedImage = self.processPaddedMask(thresholdImage, morphologyPadding,
+      [2 * radius for radius in morphologyRadius],
+      lambda maskImage: self.closeAndFillMask(maskImage, morphologyRadius, closingMethod))
+    if samplingFactor > 1 and task["refineCoarseSurface"]:
+      if not startStage("Refining the surface", 0.6):
+        return None
+      coarseImage = holefilledImage
+      holefilledImage, subtractedImage = self.processPaddedMask(task["thresholdImage"], padding,
+        [2 * radius for radius in closingRadius],
+        lambda maskImage: self.refineMaskBand(coarseImage, maskImage, [samplingFactor] * 3, closingRadius, closingMethod))
+    return holefilledImage, subtractedImage
+
+  def finishModelTask(self, task, holefilledImage, subtractedImage):
+    """Add the masks of a task to the scene, extract the skin surface or take it from the
+    disk cache, and cache the result.
+    """
+    outputModelNode = task["outputModelNode"]
+    self.holefilledImageNode = self.volumeFromImage(holefilledImage, "holefilledImage")
+    self.subtractedImageNode = self.volumeFromImage(subtractedImage, "subtractedImage")
+    if task["diskCacheSurface"] is not None:
+      self.diskCacheHits += 1
+      self.setDiskCacheSurface(task["diskCacheSurface"], outputModelNode)
+      self.updateSkinSurface(outputModelNode)
+    else:
+      self.createModelBasedOnImageNode(self.holefilledImageNode, outputModelNode) # for the nasion placement
+    #self.createModelBasedOnImageNode(self.subtractedImageNode, self.subtractedModel)
+    self.subtractedModel.SetDisplayVisibility(False)
+    self.cacheModelResult(task["cacheKey"], outputModelNode)
+    if task["diskCacheKey"] and task["diskCacheSurface"] is None:
+      self.saveDiskCacheEntry(task["diskCacheDirectory"], task["diskCacheKey"], holefilledImage, subtractedImage, outputModelNode.GetPolyData())
+
+  def cacheModelResult(self, cacheKey, outputModelNode):
+    polyData = vtk.vtkPolyData()
+    polyData.ShallowCopy(outputModelNode.GetPolyData())
+    self.addModelCacheEntry(cacheKey, {"holefilledImageNode": self.holefilledImageNode,
+      "subtractedImageNode": self.subtractedImageNode, "polyData": polyData,
+      "unsmoothedPolyData": self.unsmoothedSkinPolyData, "surfaceSettings": self.skinSurfaceSettings})
+
+  def getModelCacheKey(self, volumeNode, thresholdValue, closingMethod):
+    """Key of the createModel masks: the input image MTime and geometry, the threshold
+    and every setting that changes the masks. The surface settings are stored with the
+    cached surface instead, so that changing them does not recompute the masks.
+    """
+    imageData = volumeNode.GetImageData()
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    geometry = tuple(ijkToRas.GetElement(row, column) for row in range(3) for column in range(4))
+    return (volumeNode.GetID(), imageData.GetMTime(), imageData.GetExtent(), geometry, float(thresholdValue),
+      closingMethod, int(self.samplingFactor), bool(self.refineCoarseSurface and int(self.samplingFactor) > 1),
+      self.cropBeforeMorphology)
+
+  def getModelCacheEntrySize(self, cacheEntry):
+    unsmoothedPolyData = cacheEntry["unsmoothedPolyData"]
+    return (cacheEntry["holefilledImageNode"].GetImageData().GetActualMemorySize()
+      + cacheEntry["subtractedImageNode"].GetImageData().GetActualMemorySize()
+      + cacheEntry["polyData"].GetActualMemorySize()
+      + (unsmoothedPolyData.GetActualMemorySize() if unsmoothedPolyData is not None else 0))
+
+  def addModelCacheEntry(self, cacheKey, cacheEntry):
+    """Store a createModel result and evict the least recently used ones until the cache
+    fits in modelCacheMemoryLimit. The newest entry is always kept.
+    """
+    self.modelCache[cacheKey] = cacheEntry
+    cacheSize = sum(self.getModelCacheEntrySize(entry) for entry in self.modelCache.values())
+    while cacheSize > self.modelCacheMemoryLimit and len(self.modelCache) > 1:
+      evictedKey, evictedEntry = self.modelCache.popitem(last=False)
+      cacheSize -= self.getModelCacheEntrySize(evictedEntry)
+      self.removeModelCacheEntryNodes(evictedEntry)
+
+  def removeModelCacheEntryNodes(self, cacheEntry):
+    for nodeName in ["holefilledImageNode", "subtractedImageNode"]:
+      if cacheEntry[nodeName] is getattr(self, nodeName):
+        setattr(self, nodeName, None)
+      slicer.mrmlScene.RemoveNode(cacheEntry[nodeName])
+
+  def clearModelCache(self):
+    for cacheEntry in self.modelCache.values():
+      self.removeModelCacheEntryNodes(cacheEntry)
+    self.modelCache.clear()
+    self.modelCacheHits = 0
+    self.modelCacheMisses = 0
+    self.diskCacheHits = 0
+
+  def getModelCacheStatistics(self):
+    """Return the createModel cache hit and miss counts, entry count and size in KiB.
+    Misses that were then loaded from the disk cache are counted in diskHits.
+    """
+    return {"hits": self.modelCacheHits, "misses": self.modelCacheMisses, "diskHits": self.diskCacheHits,
+      "entries": len(self.modelCache), "size": sum(self.getModelCacheEntrySize(entry) for entry in self.modelCache.values())}
+
+  def getDiskCacheKey(self, task):
+    """Hash of the input voxels of a createModel task, their geometry and every parameter of
+    the masks, so that the same scan loaded again in another session maps to the same disk
+    cache entry. Only reads the task, so that it can run on the worker thread.
+    """
+    voxelArray = numpy.ascontiguousarray(task["voxelArray"])
+    contentHash = hashlib.sha1(voxelArray)
+    contentHash.update(repr((voxelArray.dtype.str, voxelArray.shape, task["ijkToRas"],
+      float(task["thresholdValue"]), task["closingMethod"], task["padding"], task["closingRadius"],
+      task["samplingFactor"], bool(task["refineCoarseSurface"] and task["samplingFactor"] > 1))).encode("utf-8"))
+    return contentHash.hexdigest()
+
+  def getDiskCacheFiles(self, diskCacheKey, diskCacheDirectory=None):
+    return [os.path.join(diskCacheDirectory or self.diskCacheDirectory, diskCacheKey + suffix)
+      for suffix in ["_holefilled.nrrd", "_subtracted.nrrd", "_skin.vtp"]]
+
+  def readDiskCacheEntry(self, diskCacheDirectory, diskCacheKey):
+    """Read the masks and the skin surface of a disk cache entry without touching the scene.
+    Returns None if the entry is missing or was evicted by another process while being read.
+    """
+    holefilledFile, subtractedFile, surfaceFile = self.getDiskCacheFiles(diskCacheKey, diskCacheDirectory)
+    if not all(os.path.isfile(fileName) for fileName in [holefilledFile, subtractedFile, surfaceFile]):
+      return None
+    try:
+      holefilledImage = sitk.ReadImage(holefilledFile)
+      subtractedImage = sitk.ReadImage(subtractedFile)
+    except RuntimeError:
+      logging.warning('Cannot read disk cache entry %s' % diskCacheKey)
+      return None
+    reader = vtk.vtkXMLPolyDataReader()
+    reader.SetFileName(surfaceFile)
+    reader.Update()
+    if not reader.GetOutput().GetNumberOfPoints():
+      logging.warning('Cannot read disk cache entry %s' % diskCacheKey)
+      return None
+    for fileName in [holefilledFile, subtractedFile, surfaceFile]:
+      try:
+        os.utime(fileName, None)
+      except OSError:
+        pass
+    return holefilledImage, subtractedImage, reader.GetOutput()
+
+  def setDiskCacheSurface(self, polyData, outputModelNode):
+    """Show the skin surface read from the disk cache. skinSurfaceSettings is left at None
+    if the surface was saved with other surface settings.
+    """
+    self.setSkinModelDisplay(outputModelNode)
+    # the surface is kept only if it was extracted with the current surface settings
+    surfaceSettingsArray = polyData.GetFieldData().GetAbstractArray("SurfaceSettings")
+    self.unsmoothedSkinPolyData = None
+    self.skinSurfaceSettings = None
+    if surfaceSettingsArray and surfaceSettingsArray.GetNumberOfValues() and surfaceSettingsArray.GetValue(0) == repr(self.getSurfaceSettings()):
+      self.skinSurfaceSettings = self.getSurfaceSettings()
+    polyData.GetFieldData().RemoveArray("SurfaceSettings")
+    outputModelNode.SetAndObservePolyData(polyData)
+
+  def saveDiskCacheEntry(self, diskCacheDirectory, diskCacheKey, holefilledImage, subtractedImage, polyData):
+    """Write the masks as compressed NRRD and the skin surface as VTP. Each file is
+    written under a temporary name and renamed, so a process sharing the directory never
+    reads a partial file; the surface is renamed last and marks the entry as complete.
+    The surface settings of the skin surface are saved in its field data.
+    """
+    if not os.path.isdir(diskCacheDirectory):
+      try:
+        os.makedirs(diskCacheDirectory)
+      except OSError:
+        if not os.path.isdir(diskCacheDirectory):
+          logging.warning('Cannot create disk cache directory %s' % diskCacheDirectory)
+          return
+
+    surfacePolyData = vtk.vtkPolyData()
+    surfacePolyData.ShallowCopy(polyData)
+    fieldData = vtk.vtkFieldData()
+    fieldData.ShallowCopy(polyData.GetFieldData())
+    surfaceSettingsArray = vtk.vtkStringArray()
+    surfaceSettingsArray.SetName("SurfaceSettings")
+    surfaceSettingsArray.InsertNextValue(repr(self.skinSurfaceSettings))
+    fieldData.AddArray(surfaceSettingsArray)
+    surfacePolyData.SetFieldData(fieldData)
+
+    def writePolyData(fileName):
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetFileName(fileName)
+      writer.SetInputData(surfacePolyData)
+      writer.SetDataModeToAppended()
+      writer.SetCompressorTypeToZLib()
+      if not writer.Write():
+        raise IOError('Cannot write %s' % fileName)
+
+    holefilledFile, subtractedFile, surfaceFile = self.getDiskCacheFiles(diskCacheKey, diskCacheDirectory)
+    for fileName, write in [(holefilledFile, lambda temporaryFileName: sitk.WriteImage(holefilledImage, temporaryFileName, True)),
+        (subtractedFile, lambda temporaryFileName: sitk.WriteImage(subtractedImage, temporaryFileName, True)),
+        (surfaceFile, writePolyData)]:
+      # keep the extension, the writers pick the file format from it
+      fileHandle, temporaryFileName = tempfile.mkstemp(prefix="tmp", suffix=os.path.splitext(fileName)[1], dir=diskCacheDirectory)
+      os.close(fileHandle)
+      try:
+        write(temporaryFileName)
+        os.rename(temporaryFileName, fileName)
+      except (IOError, OSError, RuntimeError):
+        # another process may have written the same entry first
+        logging.warning('Cannot write disk cache file %s' % fileName)
+        if os.path.exists(temporaryFileName):
+          os.remove(temporaryFileName)
+        return
+    self.evictDiskCacheEntries(diskCacheDirectory)
+
+  def evictDiskCacheEntries(self, diskCacheDirectory=None):
+    """Delete the least recently used disk cache entries until they fit in diskCacheSizeLimit
+    bytes. Only the files named as saveDiskCacheEntry names them are counted and deleted, so
+    other files in the directory are left alone. Files removed concurrently by another process are skipped.
+    """
+    diskCacheDirectory = diskCacheDirectory or self.diskCacheDirectory
+    entries = {}
+    for fileName in os.listdir(diskCacheDirectory):
+      fileNameMatch = self.diskCacheFilePattern.match(fileName)
+      if not fileNameMatch:
+        continue
+      filePath = os.path.join(diskCacheDirectory, fileName)
+      try:
+        fileStatus = os.stat(filePath)
+      except OSError:
+        continue
+      entryFiles = entries.setdefault(fileNameMatch.group(1), [])
+      entryFiles.append((fileStatus.st_mtime, fileStatus.st_size, filePath))
+    cacheSize = sum(fileSize for entryFiles in entries.values() for _, fileSize, _ in entryFiles)
+    for entryFiles in sorted(entries.values(), key=lambda files: max(files)[0]):
+      if cacheSize <= self.diskCacheSizeLimit:
+        break
+      for _, fileSize, filePath in entryFiles:
+        try:
+          os.remove(filePath)
+          cacheSize -= fileSize
+        except OSError:
+          pass
+
+  def createPreviewModel(self, inputVolume, outputModelNode, thresholdValue):
+    """Quickly show the iso-surface of the input volume at thresholdValue, extracted with
+    flying edges from a downsampled copy of the volume that is kept between calls.
+    There is no morphology, decimation or smoothing; createModel replaces the preview.
+    """
+    imageData = inputVolume.GetImageData()
+    previewImageKey = (inputVolume.GetID(), imageData.GetMTime(), self.previewMaximumDimension)
+    if previewImageKey != self.previewImageKey:
+      shrinkFactor = max(1, int(math.ceil(float(max(imageData.GetDimensions())) / self.previewMaximumDimension)))
+      shrinkFilter = vtk.vtkImageShrink3D()
+      shrinkFilter.SetInputData(imageData)
+      shrinkFilter.SetShrinkFactors(shrinkFactor, shrinkFactor, shrinkFactor)
+      shrinkFilter.AveragingOn()
+      shrinkFilter.Update()
+      self.previewImageData = shrinkFilter.GetOutput()
+      self.previewImageKey = previewImageKey
+    if hasattr(vtk, "vtkFlyingEdges3D"):
+      surfaceFilter = vtk.vtkFlyingEdges3D()
+    else:
+      surfaceFilter = vtk.vtkMarchingCubes()
+    surfaceFilter.SetInputData(self.previewImageData)
+    surfaceFilter.SetValue(0, thresholdValue)
+    surfaceFilter.ComputeNormalsOff()
+    surfaceFilter.ComputeGradientsOff()
+    surfaceFilter.ComputeScalarsOff()
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    ijkToRasTransform = vtk.vtkTransform()
+    ijkToRasTransform.SetMatrix(ijkToRas)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(ijkToRasTransform)
+    transformFilter.SetInputConnection(surfaceFilter.GetOutputPort())
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformFilter.GetOutputPort())
+    normals.SplittingOff()
+    normals.ConsistencyOff()
+    if ijkToRas.Determinant() < 0:
+      normals.FlipNormalsOn()
+    normals.Update()
+    self.setSkinModelDisplay(outputModelNode)
+    outputModelNode.SetAndObservePolyData(normals.GetOutput())
+
+  def setImageGeometryFromVolume(self, image, volumeNode):
+    """Copy the geometry of a volume node to a SimpleITK image, converting RAS to LPS.
+    """
+    rasToLps = numpy.diag([-1.0, -1.0, 1.0])
+    directionMatrix = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASDirectionMatrix(directionMatrix)
+    directions = numpy.array([[directionMatrix.GetElement(row, column) for column in range(3)] for row in range(3)])
+    image.SetOrigin(rasToLps.dot(volumeNode.GetOrigin()).tolist())
+    image.SetSpacing(volumeNode.GetSpacing())
+    image.SetDirection(rasToLps.dot(directions).flatten().tolist())
+    return image
+
+  def imageFromVolume(self, volumeNode):
+    """Copy the voxels of a scalar volume node into a SimpleITK image, in the native
+    scalar type and without going through sitkUtils.
+    """
+    voxelArray = slicer.util.arrayFromVolume(volumeNode)
+    return self.setImageGeometryFromVolume(sitk.GetImageFromArray(voxelArray), volumeNode)
+
+  def thresholdVolumeToImage(self, volumeNode, thresholdValue, upperValue=10000):
+    """Threshold the voxels of a volume node through a NumPy view into a single mask buffer
+    and return it as a uint8 SimpleITK image. The input volume is never copied, and the
+    upper bound goes through a one slice scratch buffer instead of a second full mask.
+    """
+    voxelArray = slicer.util.arrayFromVolume(volumeNode)
+    maskArray = numpy.empty(voxelArray.shape, dtype=numpy.bool_)
+    numpy.greater_equal(voxelArray, thresholdValue, out=maskArray)
+    upperSliceArray = numpy.empty(voxelArray.shape[1:], dtype=numpy.bool_)
+    for sliceIndex in range(voxelArray.shape[0]):
+      numpy.less_equal(voxelArray[sliceIndex], upperValue, out=upperSliceArray)
+      numpy.logical_and(maskArray[sliceIndex], upperSliceArray, out=maskArray[sliceIndex])
+    return self.setImageGeometryFromVolume(sitk.GetImageFromArray(maskArray.view(numpy.uint8)), volumeNode)
+
+  def volumeFromImage(self, image, name):
+    """Create a scalar volume node holding a single copy of the voxels of a SimpleITK image.
+    """
+    lpsToRas = numpy.diag([-1.0, -1.0, 1.0])
+    volumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLScalarVolumeNode")
+    volumeNode.SetName(name)
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeNode.SetOrigin(lpsToRas.dot(image.GetOrigin()).tolist())
+    volumeNode.SetSpacing(image.GetSpacing())
+    directions = lpsToRas.dot(numpy.array(image.GetDirection()).reshape(3, 3))
+    directionMatrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      for column in range(3):
+        directionMatrix.SetElement(row, column, directions[row, column])
+    volumeNode.SetIJKToRASDirectionMatrix(directionMatrix)
+    if hasattr(sitk, "GetArrayViewFromImage"):
+      voxelArray = sitk.GetArrayViewFromImage(image)
+    else:
+      voxelArray = sitk.GetArrayFromImage(image)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(image.GetSize())
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxelArray.ravel(), deep=True))
+    volumeNode.SetAndObserveImageData(imageData)
+    return volumeNode
+
+  def downsampleImage(self, image, samplingFactor):
+    """Smooth the image with a Gaussian of half the coarse spacing to avoid aliasing and
+    resample it on a grid samplingFactor times coarser, covering the same extent.
+    """
+    spacing = image.GetSpacing()
+    smoothingFilter = sitk.SmoothingRecursiveGaussianImageFilter()
+    smoothingFilter.SetSigma([0.5 * samplingFactor * spacing[i] for i in range(3)])
+    smoothedImage = smoothingFilter.Execute(sitk.Cast(image, sitk.sitkFloat32))
     resampleFilter = sitk.ResampleImageFilter()
-    ventricleImage = sitk.Cast(sitkUtils.PullFromSlicer(ventricleVolume.GetID()), sitk.sitkInt16)
-    self.samplingFactor = 1
-    resampleFilter.SetSize(numpy.array(ventricleImage.GetSize()) / self.samplingFactor)
-    resampleFilter.SetOutputSpacing(numpy.array(ventricleImage.GetSpacing()) * self.samplingFactor)
-    resampleFilter.SetOutputDirection(ventricleImage.GetDirection())
-    resampleFilter.SetOutputOrigin(numpy.array(ventricleImage.GetOrigin()))
-    resampledImage = resampleFilter.Execute(ventricleImage)
-    thresholdFilter = sitk.BinaryThresholdImageFilter()
-    thresholdImage = thresholdFilter.Execute(resampledImage, thresholdValue, 10000, 1, 0)
+    resampleFilter.SetSize([int(math.ceil(float(size) / samplingFactor)) for size in image.GetSize()])
+    resampleFilter.SetOutputSpacing([spacing[i] * samplingFactor for i in range(3)])
+    resampleFilter.SetOutputDirection(image.GetDirection())
+    resampleFilter.SetOutputOrigin(image.TransformContinuousIndexToPhysicalPoint([(samplingFactor - 1) / 2.0] * 3))
+    resampleFilter.SetInterpolator(sitk.sitkLinear)
+    return resampleFilter.Execute(smoothedImage)
+
+  def refineMaskBand(self, coarseMask, fineMask, bandRadius, closingRadius, closingMethod="kernel"):
+    """Resample the coarse closed mask onto the grid of fineMask and, within bandRadius voxels
+    of its boundary, replace it by fineMask closed with a kernel of closingRadius, as the
+    coarse mask was. The closing only runs on the bounding box of the band grown by twice
+    closingRadius, which gives the same band as closing the whole mask.
+    Returns the refined mask and its shell.
+    """
+    linearMask = sitk.Resample(sitk.Cast(coarseMask, sitk.sitkFloat32), fineMask, sitk.Transform(), sitk.sitkLinear, 0.0)
+    upsampledMask = sitk.BinaryThreshold(linearMask, 0.5, 1e10, 1, 0)
+    # one signed distance map gives both the core and the band around the coarse boundary
+    distanceImage = self.distanceToForeground(upsampledMask, bandRadius)
+    innerImage = sitk.BinaryThreshold(distanceImage, -1e10, -1.0, 1, 0)
+    bandImage = sitk.BinaryThreshold(distanceImage, -1.0, 1.0, 1, 0)
+    closedImage = sitk.Image(fineMask.GetSize(), fineMask.GetPixelID())
+    closedImage.CopyInformation(fineMask)
+    region = self.getMorphologyRegion(bandImage, [0, 0, 0], [2 * radius for radius in closingRadius])
+    if region:
+      lowerIndex, upperIndex = region
+      regionImage = self.extractPaddedRegion(fineMask, lowerIndex, upperIndex)
+      closedRegionImage = self.distanceErode(self.distanceDilate(regionImage, closingRadius), closingRadius)
+      closedImage = sitk.Paste(closedImage, sitk.Cast(closedRegionImage, fineMask.GetPixelID()), closedRegionImage.GetSize(), [0, 0, 0], lowerIndex)
+    fillHoleFilter = sitk.BinaryFillholeImageFilter()
+    refinedImage = self.executeMaskFilter(fillHoleFilter, sitk.Or(innerImage, sitk.And(bandImage, closedImage)))
+    shellRadius = [(radius + 1) // 2 for radius in closingRadius]
+    return refinedImage, self.computeShell(refinedImage, shellRadius, closingMethod)
+
+  def processPaddedMask(self, maskImage, padding, margin, processMask):
+    """Pad maskImage by padding and run processMask on it, which returns images with the
+    geometry of its input. With cropBeforeMorphology only the foreground bounding box grown
+    by margin is processed, and the results are pasted back into the padded geometry.
+    """
+    region = None
+    if self.cropBeforeMorphology:
+      region = self.getMorphologyRegion(maskImage, padding, margin)
+    if region:
+      lowerIndex, upperIndex = region
+      results = processMask(self.extractPaddedRegion(maskImage, lowerIndex, upperIndex))
+      pasteIndex = [lowerIndex[i] + padding[i] for i in range(3)]
+      return [self.pasteIntoPaddedImage(result, maskImage, padding, pasteIndex) for result in results]
     padFilter = sitk.ConstantPadImageFilter()
-    padFilter.SetPadLowerBound([10, 10, 10])
-    padFilter.SetPadUpperBound([10, 10, 10])
-    paddedImage = padFilter.Execute(thresholdImage)
-    dilateFilter = sitk.BinaryDilateImageFilter()
-    dilateFilter.SetKernelRadius([10, 10, 6])
-    dilateFilter.SetBackgroundValue(0)
-    dilateFilter.SetForegroundValue(1)
-    dilatedImage = dilateFilter.Execute(paddedImage)
-    erodeFilter = sitk.BinaryErodeImageFilter()
-    erodeFilter.SetKernelRadius([10, 10, 6])
-    erodeFilter.SetBackgroundValue(0)
-    erodeFilter.SetForegroundValue(1)
-    erodedImage = erodeFilter.Execute(dilatedImage)
+    padFilter.SetPadLowerBound(padding)
+    padFilter.SetPadUpperBound(padding)
+    return processMask(padFilter.Execute(maskImage))
+
+  def closeAndFillMask(self, maskImage, closingRadius, closingMethod="kernel"):
+    """Close the binary mask, fill its holes and return the filled mask together with
+    the shell obtained by subtracting it from its dilation.
+    """
+    if closingMethod == "distance":
+      dilatedImage = self.distanceDilate(maskImage, closingRadius)
+      erodedImage = self.distanceErode(dilatedImage, closingRadius)
+    else:
+      dilateFilter = sitk.BinaryDilateImageFilter()
+      dilateFilter.SetKernelRadius(closingRadius)
+      dilateFilter.SetBackgroundValue(0)
+      dilateFilter.SetForegroundValue(1)
+      dilatedImage = self.executeMaskFilter(dilateFilter, maskImage)
+      erodeFilter = sitk.BinaryErodeImageFilter()
+      erodeFilter.SetKernelRadius(closingRadius)
+      erodeFilter.SetBackgroundValue(0)
+      erodeFilter.SetForegroundValue(1)
+      erodedImage = self.executeMaskFilter(erodeFilter, dilatedImage)
     fillHoleFilter = sitk.BinaryFillholeImageFilter()
-    holefilledImage = fillHoleFilter.Execute(erodedImage)
-    dilateFilter.SetKernelRadius([5, 5, 3])
-    dilateFilter.SetBackgroundValue(0)
-    dilateFilter.SetForegroundValue(1)
-    dilatedImage = dilateFilter.Execute(holefilledImage)
+    holefilledImage = self.executeMaskFilter(fillHoleFilter, erodedImage)
+    shellRadius = [(radius + 1) // 2 for radius in closingRadius]
+    return holefilledImage, self.computeShell(holefilledImage, shellRadius, closingMethod)
+
+  def executeMaskFilter(self, imageFilter, image):
+    """Execute one of the long running SimpleITK filters of the mask computation. Once
+    modelWorkerCancelEvent is set the filter is aborted at its next progress event, which
+    raises a RuntimeError, and filters that have not started yet are not run.
+    """
+    if self.modelWorkerCancelEvent.is_set():
+      raise RuntimeError("createModel was cancelled")
+    if hasattr(imageFilter, "Abort"):
+      imageFilter.AddCommand(sitk.sitkProgressEvent,
+        lambda: self.modelWorkerCancelEvent.is_set() and imageFilter.Abort())
+    return imageFilter.Execute(image)
+
+  def computeShell(self, holefilledImage, shellRadius, closingMethod="kernel"):
+    if closingMethod == "distance":
+      dilatedImage = self.distanceDilate(holefilledImage, shellRadius)
+    else:
+      dilateFilter = sitk.BinaryDilateImageFilter()
+      dilateFilter.SetKernelRadius(shellRadius)
+      dilateFilter.SetBackgroundValue(0)
+      dilateFilter.SetForegroundValue(1)
+      dilatedImage = self.executeMaskFilter(dilateFilter, holefilledImage)
     subtractFilter = sitk.SubtractImageFilter()
-    subtractedImage = subtractFilter.Execute(dilatedImage, holefilledImage)
-    self.holefilledImageNode = sitkUtils.PushToSlicer(holefilledImage, "holefilledImage", 0, False)
-    self.subtractedImageNode = sitkUtils.PushToSlicer(subtractedImage, "subtractedImage", 0, False)
-    self.createModelBasedOnImageNode(self.holefilledImageNode, outputModelNode) # for the nasion placement
-    #self.createModelBasedOnImageNode(self.subtractedImageNode, self.subtractedModel)
-    self.subtractedModel.SetDisplayVisibility(False)
-    return
+    return subtractFilter.Execute(dilatedImage, holefilledImage)
+
+  def distanceToForeground(self, maskImage, radius):
+    """Distance from each voxel to the nearest foreground voxel, with each axis scaled by
+    the kernel radius plus half a voxel, so that thresholding at 1.0 gives the same
+    ellipsoid as the ball structuring element of that radius.
+    """
+    scaledImage = sitk.Image(maskImage)
+    scaledImage.SetSpacing([1.0 / (r + 0.5) for r in radius])
+    distanceFilter = sitk.SignedMaurerDistanceMapImageFilter()
+    distanceFilter.SetInsideIsPositive(False)
+    distanceFilter.SetSquaredDistance(False)
+    distanceFilter.SetUseImageSpacing(True)
+    distanceFilter.SetBackgroundValue(0)
+    distanceImage = self.executeMaskFilter(distanceFilter, scaledImage)
+    distanceImage.CopyInformation(maskImage)
+    return distanceImage
+
+  def distanceDilate(self, maskImage, radius):
+    distanceImage = self.distanceToForeground(maskImage, radius)
+    return sitk.BinaryThreshold(distanceImage, -1e10, 1.0, 1, 0)
+
+  def distanceErode(self, maskImage, radius):
+    backgroundImage = sitk.BinaryThreshold(maskImage, 0, 0, 1, 0)
+    distanceImage = self.distanceToForeground(backgroundImage, radius)
+    # keep the voxels whose nearest background voxel lies outside the kernel
+    return sitk.BinaryThreshold(distanceImage, -1e10, 1.0, 0, 1)
+
+  def getMorphologyRegion(self, maskImage, padding, margin):
+    """Return the lower and upper index (inclusive, in maskImage index space) of the
+    foreground bounding box grown by margin and clipped to the padded image, or None
+    if the mask is empty. A margin of twice the closing radius keeps the erosion and
+    hole filling inside the region identical to the uncropped result.
+    """
+    statisticsFilter = sitk.LabelStatisticsImageFilter()
+    statisticsFilter.Execute(maskImage, maskImage)
+    if not statisticsFilter.HasLabel(1):
+      return None
+    boundingBox = statisticsFilter.GetBoundingBox(1)
+    size = maskImage.GetSize()
+    lowerIndex = [max(boundingBox[2 * i] - margin[i], -padding[i]) for i in range(3)]
+    upperIndex = [min(boundingBox[2 * i + 1] + margin[i], size[i] - 1 + padding[i]) for i in range(3)]
+    return lowerIndex, upperIndex
+
+  def extractPaddedRegion(self, image, lowerIndex, upperIndex):
+    """Extract the region between lowerIndex and upperIndex, padding with zeros where
+    the region extends outside the image.
+    """
+    size = image.GetSize()
+    extractLower = [max(lowerIndex[i], 0) for i in range(3)]
+    extractUpper = [min(upperIndex[i], size[i] - 1) for i in range(3)]
+    extractedImage = sitk.RegionOfInterest(image, [extractUpper[i] - extractLower[i] + 1 for i in range(3)], extractLower)
+    padFilter = sitk.ConstantPadImageFilter()
+    padFilter.SetPadLowerBound([extractLower[i] - lowerIndex[i] for i in range(3)])
+    padFilter.SetPadUpperBound([upperIndex[i] - extractUpper[i] for i in range(3)])
+    return padFilter.Execute(extractedImage)
+
+  def pasteIntoPaddedImage(self, regionImage, referenceImage, padding, pasteIndex):
+    """Paste regionImage into a zero image with the geometry of referenceImage padded by padding.
+    """
+    size = referenceImage.GetSize()
+    paddedImage = sitk.Image([size[i] + 2 * padding[i] for i in range(3)], regionImage.GetPixelID())
+    paddedImage.SetSpacing(referenceImage.GetSpacing())
+    paddedImage.SetDirection(referenceImage.GetDirection())
+    paddedImage.SetOrigin(referenceImage.TransformContinuousIndexToPhysicalPoint([-float(pad) for pad in padding]))
+    return sitk.Paste(paddedImage, regionImage, regionImage.GetSize(), [0, 0, 0], pasteIndex)
 
   def createModelBasedOnImageNode(self, imageNode, outputModelNode):
     if imageNode:
-      holefilledImageData = imageNode.GetImageData()
-      cast = vtk.vtkImageCast()
-      cast.SetInputData(holefilledImageData)
-      cast.SetOutputScalarTypeToUnsignedChar()
-      cast.Update()
-      labelVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLLabelMapVolumeNode")
-      slicer.mrmlScene.AddNode(labelVolumeNode)
-      labelVolumeNode.SetName(imageNode.GetName()+"_Label")
-      labelVolumeNode.SetSpacing(holefilledImageData.GetSpacing())
-      labelVolumeNode.SetOrigin(holefilledImageData.GetOrigin())
-      matrix = vtk.vtkMatrix4x4()
-      self.holefilledImageNode.GetIJKToRASMatrix(matrix)
-      labelVolumeNode.SetIJKToRASMatrix(matrix)
-      labelImage = cast.GetOutput()
-      labelVolumeNode.SetAndObserveImageData(labelImage)
-      outputModelNode.CreateDefaultDisplayNodes()
-      outputModelNode.GetDisplayNode().SetVisibility(1)
-      outputModelNode.GetDisplayNode().SetOpacity(0.2)
-      self.calculateSurfaceGrayScale(labelVolumeNode, outputModelNode)
-      smoother = vtk.vtkWindowedSincPolyDataFilter()
-      smoother.SetInputData(outputModelNode.GetPolyData())
-      smoother.SetNumberOfIterations(15)
-      smoother.BoundarySmoothingOn()
-      smoother.FeatureEdgeSmoothingOff()
-      smoother.SetFeatureAngle(120.0)
-      smoother.SetPassBand(0.001)
-      smoother.NonManifoldSmoothingOn()
-      smoother.NormalizeCoordinatesOn()
-      smoother.Update()
-      outputModelNode.SetAndObservePolyData(smoother.GetOutput())
+      startTime = time.time()
+      self.setSkinModelDisplay(outputModelNode)
+      if self.surfaceExtractionMethod == "cli":
+        holefilledImageData = imageNode.GetImageData()
+        cast = vtk.vtkImageCast()
+        cast.SetInputData(holefilledImageData)
+        cast.SetOutputScalarTypeToUnsignedChar()
+        cast.Update()
+        labelVolumeNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLLabelMapVolumeNode")
+        slicer.mrmlScene.AddNode(labelVolumeNode)
+        labelVolumeNode.SetName(imageNode.GetName()+"_Label")
+        labelVolumeNode.SetSpacing(holefilledImageData.GetSpacing())
+        labelVolumeNode.SetOrigin(holefilledImageData.GetOrigin())
+        matrix = vtk.vtkMatrix4x4()
+        self.holefilledImageNode.GetIJKToRASMatrix(matrix)
+        labelVolumeNode.SetIJKToRASMatrix(matrix)
+        labelImage = cast.GetOutput()
+        labelVolumeNode.SetAndObserveImageData(labelImage)
+        self.calculateSurfaceGrayScale(labelVolumeNode, outputModelNode)
+      else:
+        self.extractSurface(imageNode, outputModelNode)
+      extractTime = time.time()
+      self.unsmoothedSkinPolyData = self.decimateToBudget(outputModelNode.GetPolyData(), self.surfaceTriangleBudget)
+      decimateTime = time.time()
+      polyData = self.smoothSkinSurface(self.unsmoothedSkinPolyData)
+      self.skinSurfaceSettings = self.getSurfaceSettings()
+      outputModelNode.SetAndObservePolyData(polyData)
+      logging.info('Skin surface: %d triangles, extraction %.2f s, decimation %.2f s, smoothing %.2f s'
+        % (polyData.GetNumberOfPolys(), extractTime - startTime, decimateTime - extractTime, time.time() - decimateTime))
       return
 
+  def smoothSkinSurface(self, polyData):
+    """Smooth the skin surface, only around smoothingCenter if a smoothing region is set.
+    """
+    if self.smoothingCenter is not None and self.smoothingRadius > 0:
+      return self.smoothSurfaceRegion(polyData, self.smoothingCenter, self.smoothingRadius)
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputData(polyData)
+    smoother.SetNumberOfIterations(15)
+    smoother.BoundarySmoothingOn()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.SetFeatureAngle(120.0)
+    smoother.SetPassBand(0.001)
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.Update()
+    return smoother.GetOutput()
+
+  def getSurfaceSettings(self):
+    """Settings of the skin surface extraction and decimation, followed by the smoothing region.
+    """
+    smoothingCenter = None
+    if self.smoothingCenter is not None and self.smoothingRadius > 0:
+      smoothingCenter = tuple(round(coordinate, 3) for coordinate in self.smoothingCenter)
+    return (self.surfaceExtractionMethod, int(self.surfaceTriangleBudget), smoothingCenter,
+      float(self.smoothingRadius) if smoothingCenter else 0.0)
+
+  def updateSkinSurface(self, outputModelNode):
+    """Bring the skin surface of outputModelNode up to date with the surface settings without
+    recomputing the masks: only the smoothing is redone if just the smoothing region changed,
+    otherwise the surface is extracted again from holefilledImageNode.
+    """
+    surfaceSettings = self.getSurfaceSettings()
+    if self.skinSurfaceSettings == surfaceSettings:
+      return
+    if (self.skinSurfaceSettings is not None and self.unsmoothedSkinPolyData is not None
+        and self.skinSurfaceSettings[:2] == surfaceSettings[:2]):
+      self.setSkinModelDisplay(outputModelNode)
+      outputModelNode.SetAndObservePolyData(self.smoothSkinSurface(self.unsmoothedSkinPolyData))
+      self.skinSurfaceSettings = surfaceSettings
+    else:
+      self.createModelBasedOnImageNode(self.holefilledImageNode, outputModelNode)
+
+  def setSmoothingRegion(self, nasionNode, smoothingRadius):
+    """Limit the skin surface smoothing to smoothingRadius mm around the first fiducial of
+    nasionNode, or smooth the whole surface if the radius is 0 or there is no fiducial.
+    """
+    self.smoothingRadius = float(smoothingRadius)
+    self.smoothingCenter = None
+    if nasionNode and nasionNode.GetNumberOfFiducials() and self.smoothingRadius > 0:
+      posNasion = [0.0, 0.0, 0.0]
+      nasionNode.GetNthFiducialPosition(0, posNasion)
+      self.smoothingCenter = posNasion
+
+  def decimateToBudget(self, polyData, triangleBudget):
+    """Quadric decimation of polyData down to triangleBudget triangles, preserving the
+    enclosed volume and the mesh boundaries. Returns polyData itself if it is within budget.
+    """
+    triangleCount = polyData.GetNumberOfPolys()
+    if triangleBudget <= 0 or triangleCount <= triangleBudget:
+      return polyData
+    decimator = vtk.vtkQuadricDecimation()
+    decimator.SetInputData(polyData)
+    decimator.SetTargetReduction(1.0 - float(triangleBudget) / triangleCount)
+    if hasattr(decimator, "VolumePreservationOn"):
+      decimator.VolumePreservationOn()
+    if hasattr(decimator, "SetBoundaryWeightFactor"):
+      decimator.SetBoundaryWeightFactor(100.0)
+    decimator.Update()
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(decimator.GetOutputPort())
+    normals.ComputePointNormalsOn()
+    normals.SplittingOff()
+    normals.ConsistencyOff()
+    normals.Update()
+    return normals.GetOutput()
+
+  def smoothSurfaceRegion(self, polyData, center, radius):
+    """Apply the skin surface smoothing only to the triangles within radius of center. The
+    border of the region stays in place, so the rest of the surface is unchanged and joins
+    it without a seam.
+    """
+    triangles = self.getTriangleArray(polyData)
+    if triangles is None:
+      triangleFilter = vtk.vtkTriangleFilter()
+      triangleFilter.SetInputData(polyData)
+      triangleFilter.PassLinesOff()
+      triangleFilter.PassVertsOff()
+      triangleFilter.Update()
+      polyData = triangleFilter.GetOutput()
+      triangles = self.getTriangleArray(polyData)
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    pointsInRegion = numpy.sum((points - numpy.array(center[:3])) ** 2, axis=1) <= radius * radius
+    regionTriangles = triangles[pointsInRegion[triangles].any(axis=1)]
+    if not len(regionTriangles):
+      return polyData
+    regionPointIds, regionTriangles = numpy.unique(regionTriangles, return_inverse=True)
+    regionPoints = vtk.vtkPoints()
+    regionPoints.SetData(numpy_support.numpy_to_vtk(points[regionPointIds], deep=True))
+    regionPolyData = vtk.vtkPolyData()
+    regionPolyData.SetPoints(regionPoints)
+    regionPolyData.SetPolys(self.createCellArray(regionTriangles.reshape(-1, 3)))
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputData(regionPolyData)
+    smoother.SetNumberOfIterations(15)
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.SetFeatureAngle(120.0)
+    smoother.SetPassBand(0.001)
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    smoother.Update()
+    smoothedPoints = numpy.array(points)
+    smoothedPoints[regionPointIds] = numpy_support.vtk_to_numpy(smoother.GetOutput().GetPoints().GetData())
+    outputPoints = vtk.vtkPoints()
+    outputPoints.SetData(numpy_support.numpy_to_vtk(smoothedPoints, deep=True))
+    outputPolyData = vtk.vtkPolyData()
+    outputPolyData.ShallowCopy(polyData)
+    outputPolyData.SetPoints(outputPoints)
+    return outputPolyData
+
+  def getSurfaceDeviation(self, referencePolyData, polyData):
+    """Distances in mm from the points of polyData to the reference surface: mean, root mean
+    square and maximum.
+    """
+    distanceFilter = vtk.vtkDistancePolyDataFilter()
+    distanceFilter.SetInputData(0, polyData)
+    distanceFilter.SetInputData(1, referencePolyData)
+    distanceFilter.SignedDistanceOff()
+    distanceFilter.ComputeSecondDistanceOff()
+    distanceFilter.Update()
+    distances = numpy_support.vtk_to_numpy(distanceFilter.GetOutput().GetPointData().GetArray("Distance"))
+    return {"mean": float(distances.mean()), "rms": float(numpy.sqrt(numpy.mean(distances ** 2))), "maximum": float(distances.max())}
+
+  def setSkinModelDisplay(self, outputModelNode):
+    outputModelNode.CreateDefaultDisplayNodes()
+    outputModelNode.GetDisplayNode().SetVisibility(1)
+    outputModelNode.GetDisplayNode().SetOpacity(0.2)
+
+  def extractSurface(self, imageNode, outputModelNode, threshold=0.5):
+    """In-process equivalent of calculateSurfaceGrayScale: iso-surface at threshold
+    (flying edges, multi-threaded through vtkSMPTools), decimation, smoothing and
+    normals as done by the Grayscale Model Maker, in the RAS space of imageNode.
+    """
+    if hasattr(vtk, "vtkFlyingEdges3D"):
+      surfaceFilter = vtk.vtkFlyingEdges3D()
+    else:
+      surfaceFilter = vtk.vtkMarchingCubes()
+    surfaceFilter.SetInputData(imageNode.GetImageData())
+    surfaceFilter.SetValue(0, threshold)
+    surfaceFilter.ComputeNormalsOff()
+    surfaceFilter.ComputeGradientsOff()
+    surfaceFilter.ComputeScalarsOff()
+    decimator = vtk.vtkDecimatePro()
+    decimator.SetInputConnection(surfaceFilter.GetOutputPort())
+    decimator.SetFeatureAngle(60)
+    decimator.SplittingOff()
+    decimator.PreserveTopologyOn()
+    decimator.SetMaximumError(1)
+    targetReduction = 0.25
+    if self.surfaceTriangleBudget > 0:
+      # reach the triangle budget in this pass rather than decimating twice
+      surfaceFilter.Update()
+      triangleCount = surfaceFilter.GetOutput().GetNumberOfPolys()
+      if triangleCount:
+        targetReduction = max(targetReduction, 1.0 - float(self.surfaceTriangleBudget) / triangleCount)
+    decimator.SetTargetReduction(targetReduction)
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(decimator.GetOutputPort())
+    smoother.SetNumberOfIterations(15)
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.SetFeatureAngle(60)
+    smoother.SetPassBand(0.1)
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    ijkToRas = vtk.vtkMatrix4x4()
+    imageNode.GetIJKToRASMatrix(ijkToRas)
+    ijkToRasTransform = vtk.vtkTransform()
+    ijkToRasTransform.SetMatrix(ijkToRas)
+    transformFilter = vtk.vtkTransformPolyDataFilter()
+    transformFilter.SetTransform(ijkToRasTransform)
+    transformFilter.SetInputConnection(smoother.GetOutputPort())
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(transformFilter.GetOutputPort())
+    normals.ComputePointNormalsOn()
+    normals.SplittingOff()
+    normals.ConsistencyOn()
+    # a left-handed IJK to RAS matrix turns the triangles inside out
+    if ijkToRas.Determinant() < 0:
+      normals.FlipNormalsOn()
+    normals.Update()
+    outputModelNode.SetAndObservePolyData(normals.GetOutput())
+
   def calculateSurfaceGrayScale(self, inputVolumeNode, grayScaleModelNode):    
       parameters = {}
       parameters["InputVolume"] = inputVolumeNode.GetID()
@@ -644,6 +1979,8 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
 
   def generateBaseLabel(self, inputVolume, nasionNode, sagittalReferenceLength, coronalReferenceLength, outputModelNode):
     ###All calculation is based on the RAS coordinates system
+    previousBoxLabelExtents = self.boxLabelExtents
+    self.boxLabelExtents = []
     if inputVolume and (nasionNode.GetNumberOfMarkups()):
       self.baseVolumeNode.SetSpacing(inputVolume.GetSpacing())
       self.baseVolumeNode.SetOrigin(inputVolume.GetOrigin())
@@ -651,27 +1988,77 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
       self.guideVolumeNode.SetOrigin(inputVolume.GetOrigin())
       self.createTrueSagittalPlane(nasionNode)
       self.generateKocherNav(outputModelNode, nasionNode, sagittalReferenceLength, coronalReferenceLength)
-      baseDimension = [130, 50, 50]
       posNasion = numpy.array([0.0, 0.0, 0.0])
       nasionNode.GetNthFiducialPosition(0, posNasion)
-      basePolyData = self.generateCubeModel(posNasion, baseDimension)
-      clippedPolyDataBase = self.clipVolumeWithModel(inputVolume, basePolyData, True, 1)
       matrix = vtk.vtkMatrix4x4()
       inputVolume.GetIJKToRASMatrix(matrix)
       self.baseVolumeNode.SetIJKToRASMatrix(matrix)
+      self.guideVolumeNode.SetIJKToRASMatrix(matrix)
+      if self.boxLabelMethod != "stencil":
+        # base and merged labels are written in place, guideVolumeNode holds base OR (guide AND shell)
+        self.baseVolumeNode.SetAndObserveImageData(self.getClearedLabel(self.baseVolumeNode, inputVolume, previousBoxLabelExtents))
+        self.guideVolumeNode.SetAndObserveImageData(self.getClearedLabel(self.guideVolumeNode, inputVolume, previousBoxLabelExtents))
+        centerPos, guidanceDimension = self.getGuidanceBoundary()
+        self.composeBoxLabels(inputVolume, posNasion, centerPos, guidanceDimension)
+        return
+      clippedPolyDataBase = self.generateBoxLabel(inputVolume, posNasion, self.baseBoxDimension)
       self.baseVolumeNode.SetAndObserveImageData(clippedPolyDataBase)
       centerPos, guidanceDimension = self.getGuidanceBoundary()
-      guidancePolyData = self.generateCubeModel(centerPos, guidanceDimension)
-      clippedPolyDataGuide = self.clipVolumeWithModel(inputVolume, guidancePolyData, True, 1)
+      clippedPolyDataGuide = self.generateBoxLabel(inputVolume, centerPos, guidanceDimension)
       imageFilter = vtk.vtkImageMathematics()
       imageFilter.SetOperationToMultiply()
       imageFilter.SetInput1Data(clippedPolyDataGuide)
       imageFilter.SetInput2Data(self.subtractedImageNode.GetImageData())
       imageFilter.Update()
-      self.guideVolumeNode.SetIJKToRASMatrix(matrix)
       self.guideVolumeNode.SetAndObserveImageData(imageFilter.GetOutput())
     pass
-  
+
+  def getClearedLabel(self, labelVolumeNode, inputVolume, boxLabelExtents):
+    """Empty uint8 label over the extent of inputVolume. The label of labelVolumeNode is reused
+    when it has the same geometry, only its boxLabelExtents from the last cut are cleared.
+    """
+    inputImageData = inputVolume.GetImageData()
+    labelImageData = labelVolumeNode.GetImageData()
+    if (not boxLabelExtents or labelImageData is None or labelImageData.GetScalarType() != vtk.VTK_UNSIGNED_CHAR
+        or labelImageData.GetExtent() != inputImageData.GetExtent()
+        or labelImageData.GetSpacing() != inputImageData.GetSpacing()
+        or labelImageData.GetOrigin() != inputImageData.GetOrigin()):
+      return self.createEmptyLabel(inputImageData)
+    for extent in boxLabelExtents:
+      self.getExtentArray(labelImageData, extent)[:] = 0
+    return labelImageData
+
+  def composeBoxLabels(self, inputVolume, basePoint, guidePoint, guidanceDimension):
+    """Write the base box into the base label and base OR (guide AND shell) into the merged
+    label of guideVolumeNode, in place and in one pass over each box extent. Voxels of the
+    binary inputVolume are left out of both boxes. The box extents are added to boxLabelExtents.
+    """
+    inputImageData = inputVolume.GetImageData()
+    baseImageData = self.baseVolumeNode.GetImageData()
+    mergedImageData = self.guideVolumeNode.GetImageData()
+    for centerPoint, dimension, isGuide in [(basePoint, self.baseBoxDimension, False), (guidePoint, guidanceDimension, True)]:
+      blockImageData = self.labelOrientedBoxBlock(inputVolume, centerPoint, dimension)
+      if blockImageData is None:
+        continue
+      extent = blockImageData.GetExtent()
+      blockArray = self.getExtentArray(blockImageData, extent)
+      blockMask = blockArray.view(numpy.bool_)
+      numpy.greater(blockArray, self.getExtentArray(inputImageData, extent), out=blockMask)
+      if isGuide:
+        numpy.logical_and(blockMask, self.getExtentArray(self.subtractedImageNode.GetImageData(), extent), out=blockMask)
+      else:
+        baseArray = self.getExtentArray(baseImageData, extent)
+        numpy.bitwise_or(baseArray, blockArray, out=baseArray)
+      mergedArray = self.getExtentArray(mergedImageData, extent)
+      numpy.bitwise_or(mergedArray, blockArray, out=mergedArray)
+      self.boxLabelExtents.append(extent)
+    baseImageData.Modified()
+    mergedImageData.Modified()
+
+  def generateBoxLabel(self, inputVolume, centerPoint, dimension):
+    boxPolyData = self.generateCubeModel(centerPoint, dimension)
+    return self.clipVolumeWithModel(inputVolume, boxPolyData, True, 1)
+
   def getGuidanceBoundary(self):
     posNasion = [0.0]*3
     self.sagittalReferenceCurveManager.getFirstPoint(posNasion)
@@ -698,6 +2085,15 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
     self.coronalReferenceCurveManager.curveFiducials.GetNthFiducialPosition(markerNum - 1, entryPos)
     nasionPos = [0.0] * 3
     self.sagittalReferenceCurveManager.curveFiducials.GetNthFiducialPosition(0, nasionPos)
+    if self.splitMethod == "singlepass":
+      normal = numpy.array([math.cos(self.sagittalYawAngle), math.sin(self.sagittalYawAngle), 0.0])
+      # the left part is cut by the sagittal plane moved by 0.05*rightSide along x
+      leftLevel = -0.05 * self.rightSide * normal[0]
+      splitParts = self.splitClosedSurface(self.baseModel.GetPolyData(), nasionPos, normal, leftLevel)
+      if splitParts is not None:
+        self.rightPart.SetAndObservePolyData(splitParts[0])
+        self.leftPart.SetAndObservePolyData(splitParts[1])
+        return
     trueSagittalPlane = vtk.vtkPlane()
     trueSagittalPlane.SetOrigin(nasionPos[0], nasionPos[1], nasionPos[2])
     trueSagittalPlane.SetNormal(math.cos(self.sagittalYawAngle), math.sin(self.sagittalYawAngle), 0)
@@ -714,6 +2110,143 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
     cuttedPolyData = self.getClosedCuttedModel(planes, self.baseModel.GetPolyData())
     self.leftPart.SetAndObservePolyData(cuttedPolyData)
 
+  def splitClosedSurface(self, polyData, origin, normal, leftLevel):
+    """Split a closed triangle mesh in one pass into the part on the normal side of the
+    plane through origin and the part beyond leftLevel on the other side, both capped, as
+    vtkClipClosedSurface does with the two planes of cutModel. Only the triangles crossing
+    a plane are clipped; cut points are shared by the clipped triangles and the caps.
+    Returns None if the mesh is not made of triangles only.
+    """
+    triangles = self.getTriangleArray(polyData)
+    if triangles is None:
+      return None
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    distances = (points - numpy.array(origin)).dot(normal)
+
+    def clipSide(sideDistances, sideNormal):
+      # points within splitTolerance are cut exactly, instead of leaving slivers next to them
+      sideDistances[numpy.abs(sideDistances) < self.splitTolerance] = 0.0
+      triangleDistances = sideDistances[triangles]
+      minimumDistance = numpy.minimum(numpy.minimum(triangleDistances[:, 0], triangleDistances[:, 1]), triangleDistances[:, 2])
+      maximumDistance = numpy.maximum(numpy.maximum(triangleDistances[:, 0], triangleDistances[:, 1]), triangleDistances[:, 2])
+      del triangleDistances
+      return self.clipTriangles(polyData, triangles, sideDistances, sideNormal,
+        minimumDistance >= 0, (minimumDistance < 0) & (maximumDistance >= 0))
+
+    leftPart = clipSide(leftLevel - distances, -numpy.asarray(normal))
+    rightPart = clipSide(distances, numpy.asarray(normal))
+    return rightPart, leftPart
+
+  def getTriangleArray(self, polyData):
+    """Point ids of the polygons of polyData, one row per triangle, or None if it has
+    other cells than triangles.
+    """
+    if not polyData or not polyData.GetNumberOfPolys() or polyData.GetNumberOfStrips() or polyData.GetNumberOfLines():
+      return None
+    polys = polyData.GetPolys()
+    if hasattr(polys, "GetConnectivityArray"):
+      if polys.IsHomogeneous() != 3:
+        return None
+      return numpy_support.vtk_to_numpy(polys.GetConnectivityArray()).reshape(-1, 3)
+    cellArray = numpy_support.vtk_to_numpy(polys.GetData())
+    if len(cellArray) != 4 * polyData.GetNumberOfPolys() or numpy.any(cellArray[::4] != 3):
+      return None
+    return cellArray.reshape(-1, 4)[:, 1:]
+
+  def clipTriangles(self, polyData, triangles, distances, normal, insideTriangles, crossingTriangles):
+    """Keep the triangles where distances >= 0, clip the crossing ones and close the cut with
+    a cap facing -normal. Point data is interpolated at the cut points.
+    """
+    pointCount = len(distances)
+    crossing = triangles[crossingTriangles]
+    crossingInside = distances[crossing] >= 0
+    # rotate each crossing triangle so that its first vertex is the one alone on its side
+    insideCount = crossingInside.sum(axis=1)
+    loneInside = numpy.where(insideCount == 1, numpy.argmax(crossingInside, axis=1), numpy.argmin(crossingInside, axis=1))
+    rotation = (loneInside[:, numpy.newaxis] + numpy.arange(3)) % 3
+    crossing = crossing[numpy.arange(len(crossing))[:, numpy.newaxis], rotation]
+    # one cut point per crossing edge, shared by the two triangles of the edge
+    edges = numpy.concatenate([crossing[:, [0, 1]], crossing[:, [0, 2]]]).astype(numpy.int64)
+    edges.sort(axis=1)
+    uniqueKeys, uniqueEdgeIndices, edgeCutIndices = numpy.unique(edges[:, 0] * pointCount + edges[:, 1],
+      return_index=True, return_inverse=True)
+    uniqueEdges = edges[uniqueEdgeIndices]
+    startDistance = distances[uniqueEdges[:, 0]]
+    endDistance = distances[uniqueEdges[:, 1]]
+    cutWeight = (startDistance / (startDistance - endDistance))[:, numpy.newaxis]
+    # cut points that fall on a vertex are that vertex
+    cutPointIds = pointCount + numpy.arange(len(uniqueEdges))
+    cutPointIds[startDistance == 0] = uniqueEdges[startDistance == 0, 0]
+    cutPointIds[endDistance == 0] = uniqueEdges[endDistance == 0, 1]
+    cutIds = cutPointIds[edgeCutIndices.ravel()].reshape(2, -1)
+    cutAfterFirst, cutBeforeFirst = cutIds[0], cutIds[1]
+    oneInside = insideCount == 1
+    twoInside = ~oneInside
+    # every point on the inside is used by a triangle, the cut points that are not vertices follow them
+    usedPoints = numpy.concatenate([distances >= 0, cutPointIds >= pointCount])
+    outputPointIds = numpy.cumsum(usedPoints) - 1
+    clippedTriangles = outputPointIds[numpy.concatenate([
+      numpy.stack([crossing[:, 0], cutAfterFirst, cutBeforeFirst], axis=1)[oneInside],
+      numpy.stack([cutAfterFirst, crossing[:, 1], crossing[:, 2]], axis=1)[twoInside],
+      numpy.stack([cutAfterFirst, crossing[:, 2], cutBeforeFirst], axis=1)[twoInside]])]
+    # cap edges run against the boundary edges of the clipped triangles
+    capEdges = outputPointIds[numpy.concatenate([numpy.stack([cutBeforeFirst, cutAfterFirst], axis=1)[oneInside],
+      numpy.stack([cutAfterFirst, cutBeforeFirst], axis=1)[twoInside]])]
+    capEdges = capEdges[capEdges[:, 0] != capEdges[:, 1]]
+
+    def interpolate(values):
+      cutValues = values[uniqueEdges[:, 0]] + cutWeight * (values[uniqueEdges[:, 1]] - values[uniqueEdges[:, 0]])
+      return cutValues.astype(values.dtype)
+
+    outputPolyData = vtk.vtkPolyData()
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    outputPoints = vtk.vtkPoints()
+    outputPoints.SetData(numpy_support.numpy_to_vtk(numpy.concatenate([points[usedPoints[:pointCount]],
+      interpolate(points)[usedPoints[pointCount:]]]), deep=True))
+    outputPolyData.SetPoints(outputPoints)
+    capData = vtk.vtkPolyData()
+    capData.SetPoints(outputPoints)
+    capData.SetLines(self.createCellArray(capEdges))
+    capPolys = vtk.vtkCellArray()
+    if len(capEdges):
+      vtk.vtkContourTriangulator.TriangulateContours(capData, 0, len(capEdges), capPolys, list(-normal))
+    if capPolys.GetNumberOfCells():
+      clippedTriangles = numpy.concatenate([clippedTriangles, numpy_support.vtk_to_numpy(capPolys.GetData()).reshape(-1, 4)[:, 1:]])
+    # triangles whose cut points fell on their vertices are degenerate
+    clippedTriangles = clippedTriangles[(clippedTriangles[:, 0] != clippedTriangles[:, 1])
+      & (clippedTriangles[:, 1] != clippedTriangles[:, 2]) & (clippedTriangles[:, 2] != clippedTriangles[:, 0])]
+    outputPolyData.SetPolys(self.createCellArray(numpy.concatenate([outputPointIds[triangles[insideTriangles]], clippedTriangles])))
+    inputPointData = polyData.GetPointData()
+    for arrayIndex in range(inputPointData.GetNumberOfArrays()):
+      inputArray = inputPointData.GetArray(arrayIndex)
+      if inputArray is None:
+        continue
+      values = numpy_support.vtk_to_numpy(inputArray)
+      if values.ndim == 1:
+        values = values[:, numpy.newaxis]
+      outputArray = numpy_support.numpy_to_vtk(numpy.concatenate([values[usedPoints[:pointCount]],
+        interpolate(values)[usedPoints[pointCount:]]]), deep=True)
+      outputArray.SetName(inputArray.GetName())
+      outputPolyData.GetPointData().AddArray(outputArray)
+    if inputPointData.GetNormals():
+      outputPolyData.GetPointData().SetActiveNormals(inputPointData.GetNormals().GetName())
+    return outputPolyData
+
+  def createCellArray(self, cellPointIds):
+    """Cell array of the cells of equal size given as rows of point ids.
+    """
+    cellCount, cellSize = cellPointIds.shape
+    idType = numpy_support.get_numpy_array_type(vtk.VTK_ID_TYPE)
+    cellArray = vtk.vtkCellArray()
+    if hasattr(cellArray, "GetConnectivityArray"):
+      offsets = numpy.arange(0, cellSize * cellCount + 1, cellSize, dtype=idType)
+      cellArray.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+        numpy_support.numpy_to_vtkIdTypeArray(numpy.ascontiguousarray(cellPointIds, dtype=idType).ravel(), deep=True))
+    else:
+      legacyCells = numpy.hstack([numpy.full((cellCount, 1), cellSize, dtype=idType), cellPointIds.astype(idType)])
+      cellArray.SetCells(cellCount, numpy_support.numpy_to_vtkIdTypeArray(legacyCells.ravel(), deep=True))
+    return cellArray
+
   def generateCubeModel(self, centerPoint, dimension):
     cube = vtk.vtkCubeSource()
     fullMatrix = self.calculateMatrixBasedPos(centerPoint, self.sagittalYawAngle, 0.0, 0.0)
@@ -737,9 +2270,7 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
       posNasion = numpy.array([0.0, 0.0, 0.0])
       nasionNode.GetNthFiducialPosition(0, posNasion)
       sagittalPoints = vtk.vtkPoints()
-      self.getIntersectPoints(polyData, self.trueSagittalPlane, posNasion, sagittalReferenceLength, 0, sagittalPoints)
-      ## Sorting
-      self.sortPoints(sagittalPoints, posNasion)
+      self.getOrderedIntersectPoints(polyData, self.trueSagittalPlane, posNasion, sagittalReferenceLength, 0, sagittalPoints)
       self.constructCurveReference(self.sagittalReferenceCurveManager, sagittalPoints, sagittalReferenceLength)
       ##To do, calculate the curvature value points by point might be necessary to exclude the outliers
       if self.topPoint:
@@ -749,12 +2280,17 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
         coronalPlane.SetOrigin(posNasionBack100[0], posNasionBack100[1], posNasionBack100[2])
         coronalPlane.SetNormal(math.sin(self.sagittalYawAngle), -math.cos(self.sagittalYawAngle), 0)
         coronalPoints.InsertNextPoint(posNasionBack100)
-        self.getIntersectPoints(polyData, coronalPlane, posNasionBack100, coronalReferenceLength, 1, coronalPoints)
-
-        ## Sorting
-        self.sortPoints(coronalPoints, posNasionBack100)
+        self.getOrderedIntersectPoints(polyData, coronalPlane, posNasionBack100, coronalReferenceLength, 1, coronalPoints)
         self.constructCurveReference(self.coronalReferenceCurveManager, coronalPoints, coronalReferenceLength)
 
+  def getOrderedIntersectPoints(self, polyData, plane, referencePoint, targetDistance, axis, intersectPoints):
+    if self.pointOrderingMethod == "contour":
+      self.getContourPoints(polyData, plane, referencePoint, targetDistance, axis, intersectPoints)
+    else:
+      self.getIntersectPoints(polyData, plane, referencePoint, targetDistance, axis, intersectPoints)
+      ## Sorting
+      self.sortPoints(intersectPoints, referencePoint)
+
   def getIntersectPoints(self, polyData, plane, referencePoint, targetDistance, axis, intersectPoints):
     cutter = vtk.vtkCutter()
     cutter.SetCutFunction(plane)
@@ -762,90 +2298,147 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
     cutter.Update()
     cuttedPolyData = cutter.GetOutput()
     points = cuttedPolyData.GetPoints()
-    for iPos in range(points.GetNumberOfPoints()):
-      posModel = numpy.array(points.GetPoint(iPos))
-      ## distance calculation could be simplified if the patient is well aligned in the scanner
-      distanceModelNasion = numpy.linalg.norm(posModel - referencePoint)
-      valid = False
+    if points is None or points.GetNumberOfPoints() == 0:
+      return
+    referencePoint = numpy.array(referencePoint, dtype=numpy.float64)
+    posModel = numpy_support.vtk_to_numpy(points.GetData()).astype(numpy.float64)
+    ## distance calculation could be simplified if the patient is well aligned in the scanner
+    offsets = posModel - referencePoint
+    valid = numpy.sqrt(numpy.sum(offsets * offsets, axis=1)) < targetDistance
+    if axis == 0:
+      valid &= posModel[:, 2] >= referencePoint[2]
+    elif axis == 1:
+      if self.useLeftHemisphere:
+        valid &= posModel[:, 0] <= referencePoint[0]
+      else:
+        valid &= posModel[:, 0] >= referencePoint[0]
+    else:
+      return
+    if not valid.any():
+      return
+    self.appendPointArray(intersectPoints, posModel[valid])
+
+  def getContourPoints(self, polyData, plane, referencePoint, targetDistance, axis, intersectPoints):
+    """Join the cutter output into polylines with vtkStripper and walk the one passing
+    closest to the reference point, in the superior (axis 0) or lateral (axis 1) direction,
+    until targetDistance of arc length is covered. The points are appended in contour order,
+    so no sorting is needed.
+    """
+    cutter = vtk.vtkCutter()
+    cutter.SetCutFunction(plane)
+    cutter.SetInputData(polyData)
+    stripper = vtk.vtkStripper()
+    stripper.SetInputConnection(cutter.GetOutputPort())
+    stripper.JoinContiguousSegmentsOn()
+    stripper.Update()
+    strippedPolyData = stripper.GetOutput()
+    if strippedPolyData.GetNumberOfPoints() == 0 or strippedPolyData.GetNumberOfLines() == 0:
+      return
+    referencePoint = numpy.array(referencePoint, dtype=numpy.float64)
+    positions = numpy_support.vtk_to_numpy(strippedPolyData.GetPoints().GetData()).astype(numpy.float64)
+    offsets = positions - referencePoint
+    closestId = numpy.argmin(numpy.sum(offsets * offsets, axis=1))
+    # Legacy cell array layout: [n, id_0 ... id_n-1, n, ...]
+    connectivity = numpy_support.vtk_to_numpy(strippedPolyData.GetLines().GetData())
+    polyline = None
+    index = 0
+    while index < len(connectivity):
+      numberOfIds = connectivity[index]
+      ids = connectivity[index + 1:index + 1 + numberOfIds]
+      if (ids == closestId).any():
+        polyline = ids
+        break
+      index += numberOfIds + 1
+    if polyline is None:
+      return
+    closed = len(polyline) > 2 and polyline[0] == polyline[-1]
+    if closed:
+      polyline = polyline[:-1]
+    start = int(numpy.nonzero(polyline == closestId)[0][0])
+    if closed:
+      directions = [numpy.roll(polyline, -start), numpy.roll(polyline[::-1], start + 1 - len(polyline))]
+    else:
+      directions = [polyline[start:], polyline[start::-1]]
+    sign = -1.0 if self.useLeftHemisphere else 1.0
+    bestPath = None
+    bestScore = None
+    for pathIds in directions:
+      path = positions[pathIds]
+      steps = numpy.sqrt(numpy.sum(numpy.diff(path, axis=0) ** 2, axis=1))
+      arcLength = numpy.concatenate(([0.0], numpy.cumsum(steps)))
+      # keep the first point beyond the target so that the destination can be reached
+      numberOfPoints = min(numpy.searchsorted(arcLength, targetDistance, side='right') + 1, len(path))
+      endPoint = path[numberOfPoints - 1]
       if axis == 0:
-        valid = posModel[2] >= referencePoint[2]
-      elif axis == 1:
-        if self.useLeftHemisphere:
-          valid = posModel[0] <= referencePoint[0]
-        else:
-          valid = posModel[0] >= referencePoint[0]
-      if (distanceModelNasion < targetDistance) and valid:
-        intersectPoints.InsertNextPoint(posModel)
+        score = endPoint[2] - referencePoint[2]
+      else:
+        score = sign * (endPoint[0] - referencePoint[0])
+      if bestScore is None or score > bestScore:
+        bestScore = score
+        bestPath = path[:numberOfPoints]
+    self.appendPointArray(intersectPoints, bestPath)
+
+  def appendPointArray(self, points, pointArray):
+    """Append an N x 3 array to a vtkPoints object with a single SetData call.
+    """
+    if len(pointArray) == 0:
+      return
+    if points.GetNumberOfPoints():
+      pointArray = numpy.vstack((numpy_support.vtk_to_numpy(points.GetData()), pointArray))
+    points.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(pointArray), deep=True))
 
   def sortPoints(self, inputPointVector, referencePoint):
-    minDistanceIndex = 0
-    minDistance = 1e10
-    for iPos in range(inputPointVector.GetNumberOfPoints()):
-      currentPos = numpy.array(inputPointVector.GetPoint(iPos))
-      minDistance = numpy.linalg.norm(currentPos - referencePoint)
-      minDistanceIndex = iPos
-      for jPos in range(iPos, inputPointVector.GetNumberOfPoints()):
-        posModelPost = numpy.array(inputPointVector.GetPoint(jPos))
-        distanceModelPostNasion = numpy.linalg.norm(posModelPost - referencePoint)
-        if distanceModelPostNasion < minDistance:
-          minDistanceIndex = jPos
-          minDistance = distanceModelPostNasion
-      inputPointVector.SetPoint(iPos, inputPointVector.GetPoint(minDistanceIndex))
-      inputPointVector.SetPoint(minDistanceIndex, currentPos)
+    """Reorder the points in place by increasing distance to the reference point.
+    The distances are computed in one pass and the points are written back in bulk.
+    """
+    if inputPointVector.GetNumberOfPoints() < 2:
+      return
+    pointArray = numpy_support.vtk_to_numpy(inputPointVector.GetData())
+    offsets = pointArray.astype(numpy.float64) - numpy.array(referencePoint, dtype=numpy.float64)
+    distances = numpy.sqrt(numpy.sum(offsets * offsets, axis=1))
+    order = numpy.argsort(distances, kind='mergesort')
+    inputPointVector.SetData(numpy_support.numpy_to_vtk(pointArray[order], deep=True))
 
   def constructCurveReference(self, CurveManager, points, distance):
-    step = int(0.1 * points.GetNumberOfPoints())
+    """Pick the curve fiducials from the ordered points: every step-th point until the
+    polyline length exceeds 85% of the distance, then the first point reaching the distance.
+    Lengths are computed with NumPy and the fiducials are set with setCurvePoints,
+    so the curve is only rebuilt once at the end.
+    """
+    numberOfPoints = points.GetNumberOfPoints()
+    if numberOfPoints == 0:
+      return
+    step = max(int(0.1 * numberOfPoints), 1)
     CurveManager.step = step
     ApproximityPos = distance * 0.85
     DestiationPos = distance
+    positions = numpy_support.vtk_to_numpy(points.GetData()).astype(numpy.float64)
 
-    if CurveManager.curveFiducials == None:
-      CurveManager.curveFiducials = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
-      CurveManager.curveFiducials.SetName(CurveManager.curveName)
-      slicer.mrmlScene.AddNode(CurveManager.curveFiducials)
-    else:
-      CurveManager.curveFiducials.RemoveAllMarkups()
-      CurveManager.cmLogic.updateCurve()
-
+    selectedIndices = [0]
+    curveLength = 0.0
     iPos = 0
-    iPosValid = iPos
-    posModel = numpy.array(points.GetPoint(iPos))
-    CurveManager.cmLogic.DestinationNode = CurveManager._curveModel
-    CurveManager.curveFiducials.AddFiducial(posModel[0], posModel[1], posModel[2])
-    CurveManager.cmLogic.CurvePoly = vtk.vtkPolyData()  ## For CurveMaker bug
-    # CurveManager.cmLogic.enableAutomaticUpdate(1)
-    # CurveManager.cmLogic.setInterpolationMethod(1)
-    # CurveManager.cmLogic.setTubeRadius(1.0)
-    for iPos in range(step, points.GetNumberOfPoints(), step):
-      posModel = numpy.array(points.GetPoint(iPos))
-      posModelValid = numpy.array(points.GetPoint(iPosValid))
-      if numpy.linalg.norm(posModel - posModelValid) > 50.0:
+    for iPos in range(step, numberOfPoints, step):
+      segmentLength = numpy.linalg.norm(positions[iPos] - positions[selectedIndices[-1]])
+      if segmentLength > 50.0:
         continue
-      iPosValid = iPos
-      CurveManager.curveFiducials.AddFiducial(posModel[0], posModel[1], posModel[
-        2])  # adding fiducials takes too long, check the event triggered by this operation
-      CurveManager.cmLogic.SourceNode = CurveManager.curveFiducials
-      CurveManager.cmLogic.updateCurve()
-      if CurveManager.cmLogic.CurveLength > ApproximityPos:
+      selectedIndices.append(iPos)
+      curveLength += segmentLength
+      if curveLength > ApproximityPos:
         break
-    jPos = iPosValid
-    jPosValid = jPos
-    posApprox = numpy.array(points.GetPoint(iPos))
-    for jPos in range(iPosValid, points.GetNumberOfPoints(), 1):
-      posModel = numpy.array(points.GetPoint(jPos))
-      posModelValid = numpy.array(points.GetPoint(jPosValid))
-      if numpy.linalg.norm(posModel - posModelValid) > 50.0:
-        continue
-      distance = numpy.linalg.norm(posModel - posApprox) + CurveManager.cmLogic.CurveLength
-      if (distance > DestiationPos) or (jPos == points.GetNumberOfPoints() - 1):
-        CurveManager.curveFiducials.AddFiducial(posModel[0], posModel[1], posModel[2])
-        jPosValid = jPos
-        break
-    CurveManager.cmLogic.updateCurve()
-    CurveManager.cmLogic.CurvePoly = vtk.vtkPolyData()  ## For CurveMaker bug
-    CurveManager.cmLogic.enableAutomaticUpdate(1)
-    CurveManager.cmLogic.setInterpolationMethod(1)
-    CurveManager.cmLogic.setTubeRadius(5)
+    iPosValid = selectedIndices[-1]
+    candidates = positions[iPosValid:]
+    valid = numpy.sqrt(numpy.sum((candidates - positions[iPosValid]) ** 2, axis=1)) <= 50.0
+    reached = numpy.sqrt(numpy.sum((candidates - positions[iPos]) ** 2, axis=1)) + curveLength > DestiationPos
+    reached[-1] = True
+    hits = numpy.nonzero(valid & reached)[0]
+    if len(hits):
+      jPos = iPosValid + int(hits[0])
+      selectedIndices.append(jPos)
+    else:
+      jPos = numberOfPoints - 1
+
+    CurveManager.setManagerTubeRadius(5)
+    CurveManager.setCurvePoints(positions[selectedIndices])
     self.topPoint = points.GetPoint(jPos)
 
   def calculateMatrixBasedPos(self, pos, yaw, pitch, roll):
@@ -883,7 +2476,8 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
 
   def clipVolumeWithModel(self, inputVolume, clippingPolyData, clipOutsideSurface, fillValue):
     """
-    Fill voxels of the input volume inside/outside the clipping model with the provided fill value
+    Return a uint8 label that is fillValue where the binary input volume is zero, inside
+    (clipOutsideSurface) or outside the clipping model, and 0 elsewhere
     """
     # Use the stencil to fill the volume
     ijkToRas = vtk.vtkMatrix4x4()
@@ -895,34 +2489,127 @@ class VentriculostomySurfaceCutLogic(ScriptedLoadableModuleLogic):
     transformModelToIjk.SetTransform(modelToIjkTransform)
     transformModelToIjk.SetInputData(clippingPolyData)
     transformModelToIjk.Update()
+    inputImageData = inputVolume.GetImageData()
+    inputExtent = inputImageData.GetExtent()
+    spacing = inputImageData.GetSpacing()
+    origin = inputImageData.GetOrigin()
+    # Only the voxels within the bounding box of the model can be inside of it
+    clipExtent = list(inputExtent)
+    if clipOutsideSurface:
+      bounds = transformModelToIjk.GetOutput().GetBounds()
+      for axis in range(3):
+        lowerIndex = int(math.floor((bounds[2 * axis] - origin[axis]) / spacing[axis]))
+        upperIndex = int(math.ceil((bounds[2 * axis + 1] - origin[axis]) / spacing[axis]))
+        clipExtent[2 * axis] = max(clipExtent[2 * axis], lowerIndex)
+        clipExtent[2 * axis + 1] = min(clipExtent[2 * axis + 1], upperIndex)
+      if any(clipExtent[2 * axis] > clipExtent[2 * axis + 1] for axis in range(3)):
+        return self.createEmptyLabel(inputImageData)
     # Convert model to stencil
     polyToStencil = vtk.vtkPolyDataToImageStencil()
     polyToStencil.SetInputData(transformModelToIjk.GetOutput())
-    polyToStencil.SetOutputSpacing(inputVolume.GetImageData().GetSpacing())
-    polyToStencil.SetOutputOrigin(inputVolume.GetImageData().GetOrigin())
-    polyToStencil.SetOutputWholeExtent(inputVolume.GetImageData().GetExtent())
+    polyToStencil.SetOutputSpacing(spacing)
+    polyToStencil.SetOutputOrigin(origin)
+    polyToStencil.SetOutputWholeExtent(clipExtent)
 
-    # Apply the stencil to the volume
-    stencilToImage = vtk.vtkImageStencil()
-    stencilToImage.SetInputConnection(inputVolume.GetImageDataConnection())
-    stencilToImage.SetStencilConnection(polyToStencil.GetOutputPort())
+    # Rasterize the stencil over the clip extent into a uint8 label
+    stencilToImage = vtk.vtkImageStencilToImage()
+    stencilToImage.SetInputConnection(polyToStencil.GetOutputPort())
     if clipOutsideSurface:
-      stencilToImage.ReverseStencilOff()
+      stencilToImage.SetInsideValue(1)
+      stencilToImage.SetOutsideValue(0)
     else:
-      stencilToImage.ReverseStencilOn()
-    stencilToImage.SetBackgroundValue(fillValue)
+      stencilToImage.SetInsideValue(0)
+      stencilToImage.SetOutsideValue(1)
+    stencilToImage.SetOutputScalarTypeToUnsignedChar()
     stencilToImage.Update()
-    outputImageData = vtk.vtkImageData()
-    outputImageData.DeepCopy(stencilToImage.GetOutput())  # outputImageData is the image converted from clippingPolyData
-    imgvtk = vtk.vtkImageData()
-    imgvtk.DeepCopy(outputImageData)
-    imgvtk.GetPointData().GetScalars().FillComponent(0, 1)
-    subtractFilter = vtk.vtkImageMathematics()
-    subtractFilter.SetInput1Data(imgvtk)
-    subtractFilter.SetInput2Data(outputImageData)
-    subtractFilter.SetOperationToSubtract()  # performed inverse operation on the
-    subtractFilter.Update()
-    return subtractFilter.GetOutput()
+    return self.completeBlockLabel(inputImageData, stencilToImage.GetOutput(), fillValue)
+
+  def completeBlockLabel(self, inputImageData, blockImageData, fillValue):
+    """Turn a 0/1 uint8 block covering part of the input extent into the full label:
+    clear the voxels that are non-zero in the binary input, scale by fillValue and
+    zero pad to the extent of the input.
+    """
+    inputExtent = inputImageData.GetExtent()
+    blockExtent = blockImageData.GetExtent()
+    blockDimensions = [blockExtent[2 * axis + 1] - blockExtent[2 * axis] + 1 for axis in range(3)]
+    maskArray = numpy_support.vtk_to_numpy(blockImageData.GetPointData().GetScalars())
+    maskArray = maskArray.reshape(blockDimensions[::-1])
+    inputDimensions = inputImageData.GetDimensions()
+    inputArray = numpy_support.vtk_to_numpy(inputImageData.GetPointData().GetScalars()).reshape(inputDimensions[::-1])
+    offset = [blockExtent[2 * axis] - inputExtent[2 * axis] for axis in range(3)]
+    inputArray = inputArray[offset[2]:offset[2] + blockDimensions[2],
+                            offset[1]:offset[1] + blockDimensions[1],
+                            offset[0]:offset[0] + blockDimensions[0]]
+    # mask and input are 0/1, so "mask and not input" is "mask > input", computed in place
+    numpy.greater(maskArray, inputArray, out=maskArray.view(numpy.bool_))
+    if fillValue != 1:
+      maskArray *= numpy.uint8(fillValue)
+    # Zero pad the block to the extent of the input volume
+    padFilter = vtk.vtkImageConstantPad()
+    padFilter.SetInputData(blockImageData)
+    padFilter.SetOutputWholeExtent(inputExtent)
+    padFilter.SetConstant(0)
+    padFilter.Update()
+    return padFilter.GetOutput()
+
+  def createEmptyLabel(self, inputImageData):
+    emptyImageData = vtk.vtkImageData()
+    emptyImageData.SetExtent(inputImageData.GetExtent())
+    emptyImageData.SetSpacing(inputImageData.GetSpacing())
+    emptyImageData.SetOrigin(inputImageData.GetOrigin())
+    emptyImageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    emptyImageData.GetPointData().GetScalars().FillComponent(0, 0)
+    return emptyImageData
+
+  def labelOrientedBoxBlock(self, inputVolume, centerPoint, dimension):
+    """Return the 0/1 uint8 label of the rotated box over its bounding extent within
+    inputVolume, or None if the box does not intersect the volume. This is the analytic
+    equivalent of clipping with generateCubeModel(centerPoint, dimension): a voxel is labeled
+    when its center lies in the box rotated by sagittalYawAngle about centerPoint.
+    """
+    inputImageData = inputVolume.GetImageData()
+    inputExtent = inputImageData.GetExtent()
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    # voxel index -> RAS, including the (usually trivial) origin and spacing of the image data
+    indexToIjk = numpy.diag(list(inputImageData.GetSpacing()) + [1.0])
+    indexToIjk[:3, 3] = inputImageData.GetOrigin()
+    indexToRas = numpy.array([[ijkToRas.GetElement(row, column) for column in range(4)] for row in range(4)]).dot(indexToIjk)
+    # RAS -> box frame is the yaw rotation of calculateMatrixBasedPos about the center
+    cosYaw = math.cos(self.sagittalYawAngle)
+    sinYaw = math.sin(self.sagittalYawAngle)
+    rotation = numpy.array([[cosYaw, sinYaw, 0.0], [-sinYaw, cosYaw, 0.0], [0.0, 0.0, 1.0]])
+    center = numpy.array(centerPoint[:3], dtype=numpy.float64)
+    halfDimension = 0.5 * numpy.array(dimension, dtype=numpy.float64)
+
+    corners = numpy.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)]) * halfDimension
+    rasToIndex = numpy.linalg.inv(indexToRas)
+    cornersIndex = (center + corners.dot(rotation)).dot(rasToIndex[:3, :3].T) + rasToIndex[:3, 3]
+    blockExtent = []
+    for axis in range(3):
+      blockExtent.append(max(inputExtent[2 * axis], int(math.floor(cornersIndex[:, axis].min()))))
+      blockExtent.append(min(inputExtent[2 * axis + 1], int(math.ceil(cornersIndex[:, axis].max()))))
+      if blockExtent[-2] > blockExtent[-1]:
+        return None
+
+    # box frame coordinates are linear in the voxel index
+    boxFromIndex = rotation.dot(indexToRas[:3, :3])
+    boxOffset = rotation.dot(indexToRas[:3, 3] - center)
+    indexI = numpy.arange(blockExtent[0], blockExtent[1] + 1)[numpy.newaxis, numpy.newaxis, :]
+    indexJ = numpy.arange(blockExtent[2], blockExtent[3] + 1)[numpy.newaxis, :, numpy.newaxis]
+    indexK = numpy.arange(blockExtent[4], blockExtent[5] + 1)[:, numpy.newaxis, numpy.newaxis]
+    insideBox = None
+    for axis in range(3):
+      boxCoordinate = boxFromIndex[axis, 0] * indexI + boxFromIndex[axis, 1] * indexJ + boxFromIndex[axis, 2] * indexK + boxOffset[axis]
+      insideAxis = (boxCoordinate >= -halfDimension[axis]) & (boxCoordinate < halfDimension[axis])
+      insideBox = insideAxis if insideBox is None else insideBox & insideAxis
+
+    blockImageData = vtk.vtkImageData()
+    blockImageData.SetExtent(blockExtent)
+    blockImageData.SetSpacing(inputImageData.GetSpacing())
+    blockImageData.SetOrigin(inputImageData.GetOrigin())
+    blockImageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(insideBox.view(numpy.uint8).ravel(), deep=True))
+    return blockImageData
 
 
 class VentriculostomySurfaceCutTest(ScriptedLoadableModuleTest):
@@ -942,6 +2629,36 @@ class VentriculostomySurfaceCutTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_VentriculostomySurfaceCut1()
+    self.test_SortPoints()
+    self.test_SetCurvePoints()
+    self.test_ClosingMethods()
+    self.test_ClipVolumeWithModel()
+    self.test_LabelOrientedBox()
+    self.test_ModelCache()
+    self.test_DiskCache()
+    self.test_NumberOfThreads()
+    self.test_SplitClosedSurface()
+    self.test_SurfaceBudget()
+    self.test_LabelToClosedSurface()
+    self.test_ComposeBoxLabels()
+    self.test_RecutSurface()
+    self.test_CreateModelAsync()
+    self.test_CreateSurfaceWidget()
+    self.test_CropBeforeMorphology()
+    self.test_ContourPoints()
+    self.test_ExtractSurface()
+    self.test_SamplingFactor()
+
+  def runBenchmarks(self):
+    """Log the run times and memory use on full size volumes. Too slow for runTest,
+    run it from the Python console with VentriculostomySurfaceCutTest().runBenchmarks().
+    """
+    self.setUp()
+    self.benchmark_SortPoints()
+    self.benchmark_MemoryUsage()
+    self.benchmark_ClipVolumeWithModel()
+    self.benchmark_ThreadScaling()
+    self.benchmark_SplitClosedSurface()
 
   def test_VentriculostomySurfaceCut1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -978,3 +2695,927 @@ class VentriculostomySurfaceCutTest(ScriptedLoadableModuleTest):
     logic = VentriculostomySurfaceCutLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def selectionSortPoints(self, inputPointVector, referencePoint):
+    """ The selection sort that sortPoints replaced.
+    """
+    for iPos in range(inputPointVector.GetNumberOfPoints()):
+      currentPos = numpy.array(inputPointVector.GetPoint(iPos))
+      minDistance = numpy.linalg.norm(currentPos - referencePoint)
+      minDistanceIndex = iPos
+      for jPos in range(iPos, inputPointVector.GetNumberOfPoints()):
+        distance = numpy.linalg.norm(numpy.array(inputPointVector.GetPoint(jPos)) - referencePoint)
+        if distance < minDistance:
+          minDistanceIndex = jPos
+          minDistance = distance
+      inputPointVector.SetPoint(iPos, inputPointVector.GetPoint(minDistanceIndex))
+      inputPointVector.SetPoint(minDistanceIndex, currentPos)
+
+  def createPoints(self, positions):
+    points = vtk.vtkPoints()
+    for pos in positions:
+      points.InsertNextPoint(pos)
+    return points
+
+  def test_SortPoints(self):
+    """ Check that sortPoints gives the same order as the former selection sort when no two
+    points are at the same distance. Points at equal distances keep their input order, where
+    the selection sort, which swaps points, may exchange them.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    referencePoint = numpy.array([0.0, 10.0, 20.0])
+    numpy.random.seed(0)
+    positions = numpy.random.uniform(-100.0, 100.0, (200, 3))
+    legacyPoints = self.createPoints(positions)
+    points = self.createPoints(positions)
+    self.selectionSortPoints(legacyPoints, referencePoint)
+    logic.sortPoints(points, referencePoint)
+    for iPos in range(len(positions)):
+      self.assertEqual(legacyPoints.GetPoint(iPos), points.GetPoint(iPos))
+    # two groups of points at exactly the same distance
+    positions = referencePoint + numpy.array([[10.0, 0.0, 0.0], [0.0, 10.0, 0.0], [-10.0, 0.0, 0.0],
+      [0.0, 0.0, 10.0], [5.0, 0.0, 0.0], [0.0, -5.0, 0.0]])
+    legacyPoints = self.createPoints(positions)
+    points = self.createPoints(positions)
+    self.selectionSortPoints(legacyPoints, referencePoint)
+    logic.sortPoints(points, referencePoint)
+    legacyDistances = [numpy.linalg.norm(numpy.array(legacyPoints.GetPoint(iPos)) - referencePoint) for iPos in range(len(positions))]
+    distances = [numpy.linalg.norm(numpy.array(points.GetPoint(iPos)) - referencePoint) for iPos in range(len(positions))]
+    self.assertEqual(legacyDistances, distances)
+    for iPos, inputIndex in enumerate([4, 5, 0, 1, 2, 3]):
+      self.assertEqual(points.GetPoint(iPos), tuple(positions[inputIndex]))
+    logic.clear()
+    self.delayDisplay('sortPoints test passed')
+
+  def benchmark_SortPoints(self):
+    """ Log how sortPoints and the former selection sort scale with the number of points.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    referencePoint = numpy.array([0.0, 10.0, 20.0])
+    numpy.random.seed(0)
+    for numberOfPoints in [250, 500, 1000, 2000]:
+      positions = numpy.random.uniform(-100.0, 100.0, (numberOfPoints, 3))
+      legacyPoints = self.createPoints(positions)
+      points = self.createPoints(positions)
+      startTime = time.time()
+      self.selectionSortPoints(legacyPoints, referencePoint)
+      legacyTime = time.time() - startTime
+      startTime = time.time()
+      logic.sortPoints(points, referencePoint)
+      sortTime = time.time() - startTime
+      logging.info('sortPoints %d points: selection sort %.4f s, vectorized %.4f s' % (numberOfPoints, legacyTime, sortTime))
+    logic.clear()
+    self.delayDisplay('sortPoints benchmark finished')
+
+  def test_SetCurvePoints(self):
+    """ Check that setting the curve points in bulk rebuilds the curve only once.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    curveManager = logic.sagittalReferenceCurveManager
+    curvePoints = numpy.array([[0.0, 10.0 * i, 5.0 * i] for i in range(8)])
+    # count the CurveMaker rebuilds themselves, not only the ones requested by the manager
+    rebuildCalls = []
+    rebuildCurve = curveManager.rebuildCurve
+    def countedRebuildCurve():
+      rebuildCalls.append(1)
+      rebuildCurve()
+    curveManager.rebuildCurve = countedRebuildCurve
+    rebuildCount = curveManager.curveRebuildCount
+    curveManager.setCurvePoints(curvePoints)
+    self.assertEqual(len(rebuildCalls), 1)
+    self.assertEqual(curveManager.curveRebuildCount - rebuildCount, 1)
+    # CurveMaker follows later fiducial edits again
+    curveManager.curveFiducials.SetNthFiducialPosition(0, 1.0, 0.0, 0.0)
+    self.assertGreater(len(rebuildCalls), 1)
+    curveManager.rebuildCurve = rebuildCurve
+    self.assertEqual(curveManager.curveFiducials.GetNumberOfFiducials(), len(curvePoints))
+    logic.clear()
+    curveManager.clear()
+    self.delayDisplay('setCurvePoints test passed')
+
+  def test_ClosingMethods(self):
+    """ Compare the distance map closing with the kernel based closing on a synthetic,
+    perforated head shell and log the runtime and Dice overlap of both outputs.
+    """
+    numpy.random.seed(0)
+    shape = (100, 140, 140)
+    zz, yy, xx = numpy.mgrid[0:shape[0], 0:shape[1], 0:shape[2]]
+    radius = numpy.sqrt(((xx - 70) / 50.0) ** 2 + ((yy - 70) / 60.0) ** 2 + ((zz - 50) / 45.0) ** 2)
+    shellArray = ((radius > 0.85) & (radius < 1.0)).astype(numpy.uint8)
+    shellArray[numpy.random.rand(*shape) < 0.2] = 0
+    maskImage = sitk.ConstantPad(sitk.GetImageFromArray(shellArray), [10, 10, 10], [10, 10, 10])
+    logic = VentriculostomySurfaceCutLogic()
+    results = {}
+    for closingMethod in ["kernel", "distance"]:
+      startTime = time.time()
+      results[closingMethod] = logic.closeAndFillMask(maskImage, [10, 10, 6], closingMethod)
+      logging.info('closeAndFillMask %s: %.3f s' % (closingMethod, time.time() - startTime))
+    for index, name in enumerate(["holefilled", "shell"]):
+      overlapFilter = sitk.LabelOverlapMeasuresImageFilter()
+      overlapFilter.Execute(results["kernel"][index], results["distance"][index])
+      logging.info('%s Dice kernel vs distance: %.5f' % (name, overlapFilter.GetDiceCoefficient()))
+      self.assertGreater(overlapFilter.GetDiceCoefficient(), 0.99)
+    logic.clear()
+    self.delayDisplay('Closing methods test passed')
+
+  def measurePeakMemory(self, function):
+    """ Run function while sampling the resident set size from /proc and return the
+    peak increase in bytes. Returns None where /proc is not available.
+    """
+    if not os.path.exists('/proc/self/statm'):
+      function()
+      return None
+
+    def currentMemory():
+      with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    baseline = currentMemory()
+    samples = [baseline]
+    finished = []
+
+    def sampleMemory():
+      while not finished:
+        samples.append(currentMemory())
+        time.sleep(0.002)
+
+    samplingThread = threading.Thread(target=sampleMemory)
+    samplingThread.start()
+    try:
+      function()
+      samples.append(currentMemory())
+    finally:
+      finished.append(True)
+      samplingThread.join()
+    return max(samples) - baseline
+
+  def benchmark_MemoryUsage(self):
+    """ Log the peak memory used to move a thresholded volume from Slicer to SimpleITK and
+    back, through sitkUtils as createModel used to and through the NumPy based path.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    voxelArray = numpy.zeros((256, 256, 256), dtype=numpy.int16)
+    voxelArray[40:216, 40:216, 40:216] = 100
+    volumeNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "MemoryBenchmark")
+    del voxelArray
+
+    def sitkUtilsPath():
+      image = sitk.Cast(sitkUtils.PullFromSlicer(volumeNode.GetID()), sitk.sitkInt16)
+      thresholdImage = sitk.BinaryThreshold(image, 20, 10000, 1, 0)
+      slicer.mrmlScene.RemoveNode(sitkUtils.PushToSlicer(thresholdImage, "sitkUtilsThreshold", 0, False))
+
+    def numpyPath():
+      thresholdImage = logic.thresholdVolumeToImage(volumeNode, 20)
+      slicer.mrmlScene.RemoveNode(logic.volumeFromImage(thresholdImage, "numpyThreshold"))
+
+    for name, function in [("numpy", numpyPath), ("sitkUtils", sitkUtilsPath)]:
+      peakMemory = self.measurePeakMemory(function)
+      if peakMemory is not None:
+        logging.info('%s data path peak memory increase: %.1f MB' % (name, peakMemory / 1048576.0))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    logic.clear()
+    self.delayDisplay('Memory benchmark finished')
+
+  def benchmark_ThreadScaling(self):
+    """ Log the createModel and clipping run times from one thread up to one per core.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    previousThreadCounts = (sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(), vtk.vtkMultiThreader.GetGlobalDefaultNumberOfThreads())
+    voxelArray = numpy.zeros((160, 256, 256), dtype=numpy.int16)
+    voxelArray[20:140, 30:226, 30:226] = 100
+    volumeNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "ThreadScalingInput")
+    del voxelArray
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("ThreadScalingSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    threadCounts = [1]
+    while threadCounts[-1] * 2 <= multiprocessing.cpu_count():
+      threadCounts.append(threadCounts[-1] * 2)
+    if threadCounts[-1] != multiprocessing.cpu_count():
+      threadCounts.append(multiprocessing.cpu_count())
+    runTimes = []
+    for numberOfThreads in threadCounts:
+      logic.setNumberOfThreads(numberOfThreads)
+      logic.clearModelCache()
+      startTime = time.time()
+      logic.createModel(volumeNode, modelNode, 20.0)
+      modelTime = time.time() - startTime
+      startTime = time.time()
+      logic.clipVolumeWithModel(logic.holefilledImageNode, modelNode.GetPolyData(), True, 1)
+      clipTime = time.time() - startTime
+      runTimes.append(modelTime + clipTime)
+      logging.info('%d threads: createModel %.2f s, clipVolumeWithModel %.2f s, speedup %.2f'
+        % (numberOfThreads, modelTime, clipTime, runTimes[0] / runTimes[-1]))
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(previousThreadCounts[0])
+    vtk.vtkMultiThreader.SetGlobalDefaultNumberOfThreads(previousThreadCounts[1])
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('Thread scaling benchmark finished')
+
+  def createClipInput(self, logic):
+    """ Binary volume and cube model of the clipVolumeWithModel test and benchmark.
+    """
+    voxelArray = numpy.zeros((200, 256, 256), dtype=numpy.uint8)
+    voxelArray[30:170, 40:216, 40:216] = 1
+    volumeNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "ClipInput")
+    cube = vtk.vtkCubeSource()
+    cube.SetCenter(-128.0, -128.0, 150.0)
+    cube.SetXLength(130)
+    cube.SetYLength(50)
+    cube.SetZLength(50)
+    cube.Update()
+    return volumeNode, cube.GetOutput()
+
+  def formerClipVolumeWithModel(self, volumeNode, polyData):
+    """ The stencil, deep copy and subtract implementation that clipVolumeWithModel replaced.
+    """
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    modelToIjkTransform = vtk.vtkTransform()
+    modelToIjkTransform.SetMatrix(ijkToRas)
+    modelToIjkTransform.Inverse()
+    transformModelToIjk = vtk.vtkTransformPolyDataFilter()
+    transformModelToIjk.SetTransform(modelToIjkTransform)
+    transformModelToIjk.SetInputData(polyData)
+    transformModelToIjk.Update()
+    polyToStencil = vtk.vtkPolyDataToImageStencil()
+    polyToStencil.SetInputData(transformModelToIjk.GetOutput())
+    polyToStencil.SetOutputSpacing(volumeNode.GetImageData().GetSpacing())
+    polyToStencil.SetOutputOrigin(volumeNode.GetImageData().GetOrigin())
+    polyToStencil.SetOutputWholeExtent(volumeNode.GetImageData().GetExtent())
+    stencilToImage = vtk.vtkImageStencil()
+    stencilToImage.SetInputConnection(volumeNode.GetImageDataConnection())
+    stencilToImage.SetStencilConnection(polyToStencil.GetOutputPort())
+    stencilToImage.ReverseStencilOff()
+    stencilToImage.SetBackgroundValue(1)
+    stencilToImage.Update()
+    outputImageData = vtk.vtkImageData()
+    outputImageData.DeepCopy(stencilToImage.GetOutput())
+    imgvtk = vtk.vtkImageData()
+    imgvtk.DeepCopy(outputImageData)
+    imgvtk.GetPointData().GetScalars().FillComponent(0, 1)
+    subtractFilter = vtk.vtkImageMathematics()
+    subtractFilter.SetInput1Data(imgvtk)
+    subtractFilter.SetInput2Data(outputImageData)
+    subtractFilter.SetOperationToSubtract()
+    subtractFilter.Update()
+    return subtractFilter.GetOutput()
+
+  def test_ClipVolumeWithModel(self):
+    """ Check clipVolumeWithModel against the former stencil, deep copy and subtract
+    implementation.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    volumeNode, polyData = self.createClipInput(logic)
+    formerArray = numpy_support.vtk_to_numpy(self.formerClipVolumeWithModel(volumeNode, polyData).GetPointData().GetScalars())
+    clippedArray = numpy_support.vtk_to_numpy(logic.clipVolumeWithModel(volumeNode, polyData, True, 1).GetPointData().GetScalars())
+    self.assertTrue(numpy.array_equal(formerArray, clippedArray))
+    self.assertGreater(clippedArray.sum(), 0)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    logic.clear()
+    self.delayDisplay('clipVolumeWithModel test passed')
+
+  def benchmark_ClipVolumeWithModel(self):
+    """ Log the peak memory of clipVolumeWithModel and of the former implementation.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    volumeNode, polyData = self.createClipInput(logic)
+    for name, function in [("stencilToImage", lambda: logic.clipVolumeWithModel(volumeNode, polyData, True, 1)),
+        ("former", lambda: self.formerClipVolumeWithModel(volumeNode, polyData))]:
+      peakMemory = self.measurePeakMemory(function)
+      if peakMemory is not None:
+        logging.info('%s clip peak memory increase: %.1f MB' % (name, peakMemory / 1048576.0))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    logic.clear()
+    self.delayDisplay('clipVolumeWithModel benchmark finished')
+
+  def test_LabelOrientedBox(self):
+    """ Compare the analytic box labels with the cube model clipping they replace.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    volumeNode = logic.volumeFromImage(sitk.Image(120, 110, 90, sitk.sitkUInt8), "BoxLabel")
+    volumeNode.SetSpacing(0.93, 0.93, 1.25)
+    for yawAngle in [0.0, 0.3, -0.7]:
+      logic.sagittalYawAngle = yawAngle
+      for center, dimension in [((60.0, 50.0, 40.0), (130, 50, 50)), ((40.0, 30.0, 60.0), (17.3, 23.1, 11.7)), ((-200.0, 0.0, 0.0), (10, 10, 10))]:
+        clippedImageData = logic.clipVolumeWithModel(volumeNode, logic.generateCubeModel(center, dimension), True, 1)
+        boxImageData = self.orientedBoxLabel(logic, volumeNode, center, dimension)
+        clippedArray = numpy_support.vtk_to_numpy(clippedImageData.GetPointData().GetScalars())
+        boxArray = numpy_support.vtk_to_numpy(boxImageData.GetPointData().GetScalars())
+        mismatch = numpy.count_nonzero(clippedArray != boxArray)
+        logging.info('yaw %.1f box at %s: %d stencil voxels, %d analytic voxels, %d differ' % (yawAngle, center, clippedArray.sum(), boxArray.sum(), mismatch))
+        # only voxels lying on a box face may be rounded differently
+        self.assertLessEqual(mismatch, 0.01 * max(1, boxArray.sum()))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    logic.clear()
+    self.delayDisplay('labelOrientedBoxBlock test passed')
+
+  def orientedBoxLabel(self, logic, volumeNode, centerPoint, dimension):
+    """ Full label of the analytic box over volumeNode, leaving out the voxels of the binary volumeNode.
+    """
+    blockImageData = logic.labelOrientedBoxBlock(volumeNode, centerPoint, dimension)
+    if blockImageData is None:
+      return logic.createEmptyLabel(volumeNode.GetImageData())
+    return logic.completeBlockLabel(volumeNode.GetImageData(), blockImageData, 1)
+
+  def test_ModelCache(self):
+    """ Check that createModel reuses its result until the input or the threshold changes.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    voxelArray = numpy.zeros((60, 80, 80), dtype=numpy.int16)
+    voxelArray[10:50, 15:65, 15:65] = 100
+    volumeNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "CacheInput")
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("CacheSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    logic.createModel(volumeNode, modelNode, 20.0)
+    holefilledImageNode = logic.holefilledImageNode
+    logic.createModel(volumeNode, modelNode, 20.0)
+    self.assertEqual(logic.getModelCacheStatistics()["hits"], 1)
+    self.assertTrue(logic.holefilledImageNode is holefilledImageNode)
+    self.assertGreater(modelNode.GetPolyData().GetNumberOfPoints(), 0)
+    # moving the smoothing region reuses the masks and only smooths the surface again
+    logic.smoothingCenter = [-40.0, -15.0, 30.0]
+    logic.smoothingRadius = 20.0
+    logic.createModel(volumeNode, modelNode, 20.0)
+    self.assertEqual(logic.getModelCacheStatistics()["hits"], 2)
+    self.assertTrue(logic.holefilledImageNode is holefilledImageNode)
+    self.assertEqual(logic.skinSurfaceSettings, logic.getSurfaceSettings())
+    logic.smoothingCenter = None
+    logic.createModel(volumeNode, modelNode, 50.0)
+    volumeNode.GetImageData().Modified()
+    logic.createModel(volumeNode, modelNode, 20.0)
+    statistics = logic.getModelCacheStatistics()
+    logging.info('createModel cache: %s' % statistics)
+    self.assertEqual(statistics["misses"], 3)
+    self.assertEqual(statistics["entries"], 3)
+    logic.modelCacheMemoryLimit = 0
+    logic.createModel(volumeNode, modelNode, 30.0)
+    self.assertEqual(logic.getModelCacheStatistics()["entries"], 1)
+    self.assertTrue(slicer.mrmlScene.IsNodePresent(logic.holefilledImageNode))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('createModel cache test passed')
+
+  def test_DiskCache(self):
+    """ Check that a second logic, as in a new session, loads the createModel result from disk,
+    and that a third one with a smoothing region reuses the same entry.
+    """
+    cacheDirectory = tempfile.mkdtemp()
+    voxelArray = numpy.zeros((60, 80, 80), dtype=numpy.int16)
+    voxelArray[10:50, 15:65, 15:65] = 100
+    results = []
+    cacheFiles = []
+    for smoothingCenter in [None, None, [-40.0, -15.0, 30.0]]:
+      logic = VentriculostomySurfaceCutLogic()
+      logic.diskCacheDirectory = cacheDirectory
+      logic.smoothingCenter = smoothingCenter
+      logic.smoothingRadius = 20.0
+      volumeNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "DiskCacheInput")
+      modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+      modelNode.SetName("DiskCacheSkin")
+      slicer.mrmlScene.AddNode(modelNode)
+      logic.createModel(volumeNode, modelNode, 20.0)
+      results.append((logic.getModelCacheStatistics()["diskHits"], slicer.util.arrayFromVolume(logic.holefilledImageNode).copy(),
+        modelNode.GetPolyData().GetNumberOfPoints()))
+      cacheFiles.append(sorted(os.listdir(cacheDirectory)))
+      slicer.mrmlScene.RemoveNode(volumeNode)
+      slicer.mrmlScene.RemoveNode(modelNode)
+      logic.clear()
+    self.assertEqual([result[0] for result in results], [0, 1, 1])
+    self.assertTrue(numpy.array_equal(results[0][1], results[1][1]))
+    self.assertTrue(numpy.array_equal(results[0][1], results[2][1]))
+    self.assertEqual(results[0][2], results[1][2])
+    # the smoothing region does not create another entry
+    self.assertEqual(cacheFiles[0], cacheFiles[2])
+    # files the module did not write are never evicted
+    for fileName in ["notes.txt", "scan_holefilled.nrrd"]:
+      open(os.path.join(cacheDirectory, fileName), "w").close()
+    logic.diskCacheSizeLimit = 0
+    logic.evictDiskCacheEntries()
+    self.assertEqual(sorted(os.listdir(cacheDirectory)), ["notes.txt", "scan_holefilled.nrrd"])
+    shutil.rmtree(cacheDirectory)
+    self.delayDisplay('Disk cache test passed')
+
+  def test_NumberOfThreads(self):
+    """ Check that createModel gives the same masks on one thread and on every core, and that
+    a count of 0 restores the process thread defaults.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    previousThreadCounts = (sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(), vtk.vtkMultiThreader.GetGlobalDefaultNumberOfThreads())
+    volumeNode = self.createHeadVolume(logic, "ThreadsHead")
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("ThreadsSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    masks = []
+    try:
+      for numberOfThreads in [1, multiprocessing.cpu_count()]:
+        logic.setNumberOfThreads(numberOfThreads)
+        self.assertEqual(sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(), numberOfThreads)
+        logic.clearModelCache()
+        logic.createModel(volumeNode, modelNode, 20.0)
+        masks.append([slicer.util.arrayFromVolume(imageNode).copy()
+          for imageNode in [logic.holefilledImageNode, logic.subtractedImageNode]])
+      logic.setNumberOfThreads(0)
+      self.assertEqual((sitk.ProcessObject.GetGlobalDefaultNumberOfThreads(), vtk.vtkMultiThreader.GetGlobalDefaultNumberOfThreads()),
+        VentriculostomySurfaceCutLogic.defaultNumberOfThreads)
+    finally:
+      sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(previousThreadCounts[0])
+      vtk.vtkMultiThreader.SetGlobalDefaultNumberOfThreads(previousThreadCounts[1])
+    for singleThreadArray, multiThreadArray in zip(masks[0], masks[1]):
+      self.assertTrue(numpy.array_equal(singleThreadArray, multiThreadArray))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('Number of threads test passed')
+
+  def splitAndClipSphere(self, logic, thetaResolution, phiResolution, center, nasionPos, normal, leftLevel):
+    """ Split a sphere with splitClosedSurface and with the two clips it replaces. Returns the
+    number of triangles, the split and the clipped parts and both run times.
+    """
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(center)
+    sphere.SetRadius(50.0)
+    sphere.SetThetaResolution(thetaResolution)
+    sphere.SetPhiResolution(phiResolution)
+    triangleFilter = vtk.vtkTriangleFilter()
+    triangleFilter.SetInputConnection(sphere.GetOutputPort())
+    triangleFilter.Update()
+    polyData = triangleFilter.GetOutput()
+    normal = numpy.array(normal)
+
+    startTime = time.time()
+    rightPart, leftPart = logic.splitClosedSurface(polyData, nasionPos, normal, leftLevel)
+    splitTime = time.time() - startTime
+    startTime = time.time()
+    clippedParts = []
+    for origin, planeNormal in [(nasionPos, normal), (numpy.array(nasionPos) + leftLevel * normal, -normal)]:
+      plane = vtk.vtkPlane()
+      plane.SetOrigin(origin)
+      plane.SetNormal(planeNormal)
+      planes = vtk.vtkPlaneCollection()
+      planes.AddItem(plane)
+      clippedParts.append(logic.getClosedCuttedModel(planes, polyData))
+    clipTime = time.time() - startTime
+    return polyData.GetNumberOfPolys(), [rightPart, leftPart], clippedParts, splitTime, clipTime
+
+  def test_SplitClosedSurface(self):
+    """ Compare the single pass split of a sphere with the two clips it replaces, for tilted
+    planes between the vertices and for a plane through vertices and edges of the sphere.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    normal = [math.cos(0.3), math.sin(0.3), 0.0]
+    splitResults = self.splitAndClipSphere(logic, 100, 50, [3.0, 4.0, 5.0], [1.0, 2.0, 3.0], normal, -0.05 * normal[0])
+    self.checkSplitParts(logic, splitResults[1], splitResults[2], 0.0)
+    # the x = 0 plane contains a meridian of the sphere centered at the origin, the cut must not
+    # leave slivers next to the vertices lying on it
+    splitResults = self.splitAndClipSphere(logic, 100, 50, [0.0, 0.0, 0.0], [0.0, 0.0, 0.0], [1.0, 0.0, 0.0], 0.0)
+    self.checkSplitParts(logic, splitResults[1], splitResults[2], 0.1)
+    logic.clear()
+    self.delayDisplay('Single pass split test passed')
+
+  def checkSplitParts(self, logic, splitParts, clippedParts, minimumTriangleArea):
+    """ Check that the split parts are closed, have the volume and area of the clipped parts
+    and no triangle of minimumTriangleArea mm2 or less.
+    """
+    for splitPart, clippedPart in zip(splitParts, clippedParts):
+      splitProperties = vtk.vtkMassProperties()
+      splitProperties.SetInputData(splitPart)
+      splitProperties.Update()
+      clippedProperties = vtk.vtkMassProperties()
+      clippedProperties.SetInputData(clippedPart)
+      clippedProperties.Update()
+      self.assertAlmostEqual(splitProperties.GetVolume(), clippedProperties.GetVolume(), delta=1e-4 * clippedProperties.GetVolume())
+      self.assertAlmostEqual(splitProperties.GetSurfaceArea(), clippedProperties.GetSurfaceArea(), delta=1e-4 * clippedProperties.GetSurfaceArea())
+      boundaryEdges = vtk.vtkFeatureEdges()
+      boundaryEdges.SetInputData(splitPart)
+      boundaryEdges.BoundaryEdgesOn()
+      boundaryEdges.NonManifoldEdgesOn()
+      boundaryEdges.FeatureEdgesOff()
+      boundaryEdges.ManifoldEdgesOff()
+      boundaryEdges.Update()
+      self.assertEqual(boundaryEdges.GetOutput().GetNumberOfCells(), 0)
+      trianglePoints = numpy_support.vtk_to_numpy(splitPart.GetPoints().GetData())[logic.getTriangleArray(splitPart)]
+      triangleAreas = 0.5 * numpy.linalg.norm(numpy.cross(trianglePoints[:, 1] - trianglePoints[:, 0], trianglePoints[:, 2] - trianglePoints[:, 0]), axis=1)
+      self.assertGreater(triangleAreas.min(), minimumTriangleArea)
+
+  def benchmark_SplitClosedSurface(self):
+    """ Log the run times of the single pass split and of the two clips on a 1M triangle sphere.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    normal = [math.cos(0.3), math.sin(0.3), 0.0]
+    numberOfTriangles, splitParts, clippedParts, splitTime, clipTime = self.splitAndClipSphere(logic, 1000, 500,
+      [3.0, 4.0, 5.0], [1.0, 2.0, 3.0], normal, -0.05 * normal[0])
+    logging.info('%d triangles: single pass split %.3f s, two clips %.3f s, speedup %.2f'
+      % (numberOfTriangles, splitTime, clipTime, clipTime / splitTime))
+    logic.clear()
+    self.delayDisplay('Single pass split benchmark finished')
+
+  def test_SurfaceBudget(self):
+    """ Log the timings and the deviation from the full surface of the triangle budget and
+    of the smoothing limited to the nasion region.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    z, y, x = numpy.ogrid[:180, :220, :200]
+    voxelArray = ((((x - 100) / 80.0) ** 2 + ((y - 110) / 95.0) ** 2 + ((z - 90) / 75.0) ** 2) < 1).astype(numpy.uint8)
+    imageNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "SurfaceBudgetInput")
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("SurfaceBudgetSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    referencePolyData = None
+    for name, triangleBudget, smoothingRadius in [("full", 0, 0.0), ("budget", 50000, 0.0), ("region", 0, 40.0), ("budget and region", 50000, 40.0)]:
+      logic.surfaceTriangleBudget = triangleBudget
+      logic.smoothingCenter = [-100.0, -15.0, 90.0] if smoothingRadius else None
+      logic.smoothingRadius = smoothingRadius
+      startTime = time.time()
+      logic.createModelBasedOnImageNode(imageNode, modelNode)
+      surfaceTime = time.time() - startTime
+      polyData = modelNode.GetPolyData()
+      if referencePolyData is None:
+        referencePolyData = polyData
+      deviation = logic.getSurfaceDeviation(referencePolyData, polyData)
+      logging.info('%s: %d triangles in %.2f s, deviation mean %.3f mm, rms %.3f mm, max %.3f mm'
+        % (name, polyData.GetNumberOfPolys(), surfaceTime, deviation["mean"], deviation["rms"], deviation["maximum"]))
+      if triangleBudget:
+        self.assertLessEqual(polyData.GetNumberOfPolys(), triangleBudget)
+      self.assertLess(deviation["maximum"], 1.0)
+    slicer.mrmlScene.RemoveNode(imageNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('Surface budget test passed')
+
+  def test_LabelToClosedSurface(self):
+    """ Compare the direct label to surface conversion with the segmentation conversion.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    voxelArray = numpy.zeros((200, 256, 256), dtype=numpy.uint8)
+    voxelArray[60:110, 80:200, 90:150] = 1
+    voxelArray[100:140, 120:160, 100:140] = 1
+    labelNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "LabelToSurfaceInput")
+    logic.guideVolumeNode.SetIJKToRASMatrix(vtk.vtkMatrix4x4())
+    logic.guideVolumeNode.SetAndObserveImageData(labelNode.GetImageData())
+    volumes = {}
+    for method in ["segmentation", "flyingedges"]:
+      logic.labelConversionMethod = method
+      startTime = time.time()
+      logic.convertLabelToBaseModel()
+      conversionTime = time.time() - startTime
+      massProperties = vtk.vtkMassProperties()
+      massProperties.SetInputData(logic.baseModel.GetPolyData())
+      massProperties.Update()
+      volumes[method] = massProperties.GetVolume()
+      logging.info('%s conversion: %.2f s, %d triangles, volume %.0f mm3'
+        % (method, conversionTime, logic.baseModel.GetPolyData().GetNumberOfPolys(), volumes[method]))
+    self.assertAlmostEqual(volumes["flyingedges"], volumes["segmentation"], delta=0.02 * volumes["segmentation"])
+    slicer.mrmlScene.RemoveNode(labelNode)
+    logic.clear()
+    self.delayDisplay('Label to closed surface test passed')
+
+  def test_ComposeBoxLabels(self):
+    """ Compare the fused box label composition with the vtkImageMathematics passes it replaces.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    numpy.random.seed(0)
+    inputNode = logic.volumeFromImage(sitk.GetImageFromArray((numpy.random.rand(100, 120, 140) > 0.6).astype(numpy.uint8)), "ComposeInput")
+    logic.subtractedImageNode = logic.volumeFromImage(sitk.GetImageFromArray((numpy.random.rand(100, 120, 140) > 0.5).astype(numpy.uint8)), "ComposeShell")
+    logic.sagittalYawAngle = 0.2
+    for basePoint, guidePoint, guidanceDimension in [((70.0, 60.0, 50.0), (80.0, 70.0, 60.0), (30.0, 25.0, 40.0)), ((60.0, 50.0, 40.0), (90.0, 60.0, 55.0), (20.0, 35.0, 30.0))]:
+      previousBoxLabelExtents = logic.boxLabelExtents
+      logic.boxLabelExtents = []
+      startTime = time.time()
+      logic.baseVolumeNode.SetAndObserveImageData(logic.getClearedLabel(logic.baseVolumeNode, inputNode, previousBoxLabelExtents))
+      logic.guideVolumeNode.SetAndObserveImageData(logic.getClearedLabel(logic.guideVolumeNode, inputNode, previousBoxLabelExtents))
+      logic.composeBoxLabels(inputNode, basePoint, guidePoint, guidanceDimension)
+      composeTime = time.time() - startTime
+      startTime = time.time()
+      baseImageData = self.orientedBoxLabel(logic, inputNode, basePoint, logic.baseBoxDimension)
+      guideFilter = vtk.vtkImageMathematics()
+      guideFilter.SetOperationToMultiply()
+      guideFilter.SetInput1Data(self.orientedBoxLabel(logic, inputNode, guidePoint, guidanceDimension))
+      guideFilter.SetInput2Data(logic.subtractedImageNode.GetImageData())
+      mergeFilter = vtk.vtkImageMathematics()
+      mergeFilter.SetOperationToMax()
+      mergeFilter.SetInputConnection(0, guideFilter.GetOutputPort())
+      mergeFilter.SetInput2Data(baseImageData)
+      mergeFilter.Update()
+      filterTime = time.time() - startTime
+      logging.info('box labels: composed in %.3f s, vtkImageMathematics %.3f s' % (composeTime, filterTime))
+      for labelImageData, expectedImageData in [(logic.baseVolumeNode.GetImageData(), baseImageData), (logic.guideVolumeNode.GetImageData(), mergeFilter.GetOutput())]:
+        labelArray = numpy_support.vtk_to_numpy(labelImageData.GetPointData().GetScalars())
+        expectedArray = numpy_support.vtk_to_numpy(expectedImageData.GetPointData().GetScalars())
+        self.assertEqual(numpy.count_nonzero(labelArray != expectedArray), 0)
+    slicer.mrmlScene.RemoveNode(inputNode)
+    slicer.mrmlScene.RemoveNode(logic.subtractedImageNode)
+    logic.clear()
+    self.delayDisplay('Box label composition test passed')
+
+  headSemiAxes = (35.0, 45.0, 40.0)
+
+  def createHeadVolume(self, logic, name, shape=(90, 100, 80), center=None):
+    """ Synthetic int16 head with 2 mm voxels: an ellipsoid of 100 with headSemiAxes voxels along
+    i, j and k, centered in the volume of the given k, j, i shape unless center (k, j, i) is given.
+    """
+    if center is None:
+      center = [0.5 * size for size in shape]
+    k, j, i = numpy.ogrid[:shape[0], :shape[1], :shape[2]]
+    radius = (((i - center[2]) / self.headSemiAxes[0]) ** 2 + ((j - center[1]) / self.headSemiAxes[1]) ** 2
+      + ((k - center[0]) / self.headSemiAxes[2]) ** 2)
+    voxelArray = numpy.where(radius < 1.0, 100, 0).astype(numpy.int16)
+    volumeNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), name)
+    volumeNode.SetSpacing(2.0, 2.0, 2.0)
+    return volumeNode
+
+  def headSurfacePoint(self, shape, offsetI, offsetK):
+    """ RAS position of the anterior surface of the createHeadVolume head, offsetI and offsetK
+    voxels off its center.
+    """
+    center = [0.5 * size for size in shape]
+    offsetJ = self.headSemiAxes[1] * math.sqrt(1.0 - (offsetI / self.headSemiAxes[0]) ** 2 - (offsetK / self.headSemiAxes[2]) ** 2)
+    # volumeFromImage gives the LPS identity direction, so R = -2 i, A = -2 j and S = 2 k
+    return [-2.0 * (center[2] + offsetI), -2.0 * (center[1] - offsetJ), 2.0 * (center[0] + offsetK)]
+
+  def test_RecutSurface(self):
+    """ Check that recutSurface after a nasion move gives the labels and parts of a fresh cutSurface.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    shape = (90, 100, 80)
+    volumeNode = self.createHeadVolume(logic, "RecutHead", shape)
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("RecutSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    nasionNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLMarkupsFiducialNode")
+    nasionNode.SetName("RecutNasion")
+    slicer.mrmlScene.AddNode(nasionNode)
+    nasionNode.AddFiducial(*self.headSurfacePoint(shape, 0.0, 10.0))
+    logic.createModel(volumeNode, modelNode, 20.0)
+    # the smoothed region of the skin surface follows the nasion
+    logic.smoothingRadius = 30.0
+    logic.cutSurface(nasionNode, modelNode, 100.0, 30.0)
+    self.assertTrue(logic.boxLabelExtents)
+    movedNasion = self.headSurfacePoint(shape, 4.0, 13.0)
+    nasionNode.SetNthFiducialPosition(0, *movedNasion)
+
+    def getCutResult():
+      result = {}
+      for name, labelNode in [("base", logic.baseVolumeNode), ("merged", logic.guideVolumeNode)]:
+        result[name] = numpy.copy(numpy_support.vtk_to_numpy(labelNode.GetImageData().GetPointData().GetScalars()))
+      for name, partNode in [("left", logic.leftPart), ("right", logic.rightPart)]:
+        massProperties = vtk.vtkMassProperties()
+        massProperties.SetInputData(partNode.GetPolyData())
+        massProperties.Update()
+        result[name] = massProperties.GetVolume()
+      return result
+
+    logic.recutSurface(nasionNode, modelNode, 100.0, 30.0)
+    self.assertEqual(logic.skinSurfaceSettings, logic.getSurfaceSettings())
+    numpy.testing.assert_allclose(logic.smoothingCenter, movedNasion, atol=1e-3)
+    recutResult = getCutResult()
+    logic.cutSurface(nasionNode, modelNode, 100.0, 30.0)
+    cutResult = getCutResult()
+    logging.info('recut: left part %.0f mm3, right part %.0f mm3; cut: left part %.0f mm3, right part %.0f mm3'
+      % (recutResult["left"], recutResult["right"], cutResult["left"], cutResult["right"]))
+    self.assertGreater(numpy.count_nonzero(cutResult["base"]), 0)
+    for name in ["base", "merged"]:
+      self.assertEqual(numpy.count_nonzero(recutResult[name] != cutResult[name]), 0)
+    for name in ["left", "right"]:
+      self.assertGreater(cutResult[name], 0.0)
+      self.assertAlmostEqual(recutResult[name], cutResult[name], delta=1e-3 * cutResult[name])
+    for node in [volumeNode, modelNode, nasionNode]:
+      slicer.mrmlScene.RemoveNode(node)
+    logic.clear()
+    self.delayDisplay('recutSurface test passed')
+
+  def test_CreateModelAsync(self):
+    """ Check that createModelAsync gives the mask of createModel and that a cancelled run
+    leaves the previous output untouched.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    volumeNode = self.createHeadVolume(logic, "AsyncHead")
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("AsyncSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    logic.createModel(volumeNode, modelNode, 20.0)
+    expectedArray = slicer.util.arrayFromVolume(logic.holefilledImageNode).copy()
+    logic.clearModelCache()
+
+    def waitForWorker(results):
+      startTime = time.time()
+      while not results and time.time() - startTime < 120.0:
+        slicer.app.processEvents()
+        time.sleep(0.01)
+
+    results = []
+    self.assertTrue(logic.createModelAsync(volumeNode, modelNode, 20.0, finishedCallback=results.append))
+    waitForWorker(results)
+    self.assertEqual(results, [True])
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(logic.holefilledImageNode), expectedArray))
+    polyData = modelNode.GetPolyData()
+    holefilledImageNode = logic.holefilledImageNode
+    results = []
+    self.assertTrue(logic.createModelAsync(volumeNode, modelNode, 30.0, finishedCallback=results.append))
+    logic.cancelModelAsync()
+    waitForWorker(results)
+    self.assertEqual(results, [False])
+    self.assertTrue(modelNode.GetPolyData() is polyData)
+    self.assertTrue(logic.holefilledImageNode is holefilledImageNode)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('createModelAsync test passed')
+
+  def test_CreateSurfaceWidget(self):
+    """ Create the surface twice at the same threshold through the widget in the background,
+    the second time from the memory cache, and check that the widget is ready after each run.
+    """
+    widget = VentriculostomySurfaceCutWidget()
+    widget.setup()
+    volumeNode = self.createHeadVolume(widget.logic, "WidgetHead")
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("WidgetSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    widget.inputSelector.setCurrentNode(volumeNode)
+    widget.outputSelector.setCurrentNode(modelNode)
+    widget.backgroundCheckBox.checked = True
+    widget.imageThresholdSliderWidget.value = 20.0
+    for expectedHits in [0, 1]:
+      widget.onCreateSurface()
+      startTime = time.time()
+      while not widget.onCreateSurfaceButton.enabled and time.time() - startTime < 120.0:
+        slicer.app.processEvents()
+        time.sleep(0.01)
+      self.assertTrue(widget.onCreateSurfaceButton.enabled)
+      self.assertTrue(widget.createSurfaceProgressBar.isHidden())
+      self.assertTrue(widget.cancelCreateSurfaceButton.isHidden())
+      self.assertEqual(widget.logic.getModelCacheStatistics()["hits"], expectedHits)
+    self.assertGreater(modelNode.GetPolyData().GetNumberOfPoints(), 0)
+    widget.cleanup()
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    self.delayDisplay('Create surface widget test passed')
+
+  def test_CropBeforeMorphology(self):
+    """ Check that the morphology on the cropped head gives the same masks as on the whole
+    volume, with the head touching the volume border.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    shape = (90, 100, 80)
+    # the head touches the inferior border, where a notch is cut that the closing has to bridge
+    volumeNode = self.createHeadVolume(logic, "CropHead", shape, center=(39.0, 50.0, 40.0))
+    slicer.util.arrayFromVolume(volumeNode)[0:3, 46:54, 42:48] = 0
+    volumeNode.GetImageData().Modified()
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("CropSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    masks = {}
+    for cropBeforeMorphology in [True, False]:
+      logic.cropBeforeMorphology = cropBeforeMorphology
+      logic.createModel(volumeNode, modelNode, 20.0)
+      masks[cropBeforeMorphology] = [slicer.util.arrayFromVolume(imageNode).copy()
+        for imageNode in [logic.holefilledImageNode, logic.subtractedImageNode]]
+    self.assertEqual(logic.getModelCacheStatistics()["misses"], 2)
+    for croppedArray, fullArray in zip(masks[True], masks[False]):
+      self.assertEqual(croppedArray.shape, fullArray.shape)
+      self.assertTrue(numpy.array_equal(croppedArray, fullArray))
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('cropBeforeMorphology test passed')
+
+  def test_ContourPoints(self):
+    """ Check the order, direction and length of the contour points on the cuts of a sphere,
+    for reference points all around the closed contour.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    radius = 50.0
+    targetDistance = 100.0
+    sphere = vtk.vtkSphereSource()
+    sphere.SetRadius(radius)
+    sphere.SetThetaResolution(180)
+    sphere.SetPhiResolution(180)
+    sphere.Update()
+    sagittalPlane = vtk.vtkPlane()
+    sagittalPlane.SetNormal(1.0, 0.0, 0.0)
+    # along the sagittal contour the angle runs from anterior (+A) to superior (+S)
+    for referenceAngle in [-2.5, -0.3, 1.0, 2.8]:
+      referencePoint = [0.0, radius * math.cos(referenceAngle), radius * math.sin(referenceAngle)]
+      points = vtk.vtkPoints()
+      logic.getContourPoints(sphere.GetOutput(), sagittalPlane, referencePoint, targetDistance, 0, points)
+      positions = numpy_support.vtk_to_numpy(points.GetData()).astype(numpy.float64)
+      angles = numpy.unwrap(numpy.arctan2(positions[:, 2], positions[:, 1]))
+      steps = numpy.sqrt(numpy.sum(numpy.diff(positions, axis=0) ** 2, axis=1))
+      # the points follow the contour in one direction, from the reference point on; the plane
+      # passes through sphere vertices, so the cutter repeats some points
+      self.assertLess(numpy.linalg.norm(positions[0] - referencePoint), 2.0)
+      self.assertTrue((numpy.diff(angles) >= 0).all() or (numpy.diff(angles) <= 0).all())
+      self.assertGreaterEqual(steps.sum(), targetDistance)
+      self.assertLess(steps[:-1].sum(), targetDistance)
+      # the direction reaching higher is chosen
+      endAngles = [angles[0] + targetDistance / radius, angles[0] - targetDistance / radius]
+      expectedEndAngle = max(endAngles, key=math.sin)
+      self.assertAlmostEqual(math.sin(angles[-1]), math.sin(expectedEndAngle), delta=0.05)
+    coronalPlane = vtk.vtkPlane()
+    coronalPlane.SetNormal(0.0, 1.0, 0.0)
+    points = vtk.vtkPoints()
+    logic.getContourPoints(sphere.GetOutput(), coronalPlane, [0.0, 0.0, radius], 30.0, 1, points)
+    positions = numpy_support.vtk_to_numpy(points.GetData())
+    # lateral is towards +R unless useLeftHemisphere is set
+    self.assertTrue((numpy.diff(positions[:, 0]) >= 0).all())
+    self.assertGreater(positions[-1, 0], 25.0)
+    logic.clear()
+    self.delayDisplay('getContourPoints test passed')
+
+  def test_ExtractSurface(self):
+    """ Check that extractSurface gives a closed, manifold, outward facing ellipsoid surface
+    within 1% of the analytic volume, also for a left-handed IJK to RAS matrix.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    semiAxes = [60.0, 75.0, 55.0]
+    k, j, i = numpy.ogrid[:130, :170, :140]
+    voxelArray = ((((i - 70) / semiAxes[0]) ** 2 + ((j - 85) / semiAxes[1]) ** 2 + ((k - 65) / semiAxes[2]) ** 2) < 1).astype(numpy.uint8)
+    imageNode = logic.volumeFromImage(sitk.GetImageFromArray(voxelArray), "ExtractSurfaceInput")
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("ExtractSurfaceSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    analyticVolume = 4.0 / 3.0 * math.pi * semiAxes[0] * semiAxes[1] * semiAxes[2]
+    for directions in [[-1.0, -1.0, 1.0], [1.0, -1.0, 1.0]]:
+      directionMatrix = vtk.vtkMatrix4x4()
+      for axis in range(3):
+        directionMatrix.SetElement(axis, axis, directions[axis])
+      imageNode.SetIJKToRASDirectionMatrix(directionMatrix)
+      logic.extractSurface(imageNode, modelNode)
+      polyData = modelNode.GetPolyData()
+      featureEdges = vtk.vtkFeatureEdges()
+      featureEdges.SetInputData(polyData)
+      featureEdges.BoundaryEdgesOn()
+      featureEdges.NonManifoldEdgesOn()
+      featureEdges.FeatureEdgesOff()
+      featureEdges.ManifoldEdgesOff()
+      featureEdges.Update()
+      self.assertEqual(featureEdges.GetOutput().GetNumberOfCells(), 0)
+      massProperties = vtk.vtkMassProperties()
+      massProperties.SetInputData(polyData)
+      massProperties.Update()
+      logging.info('IJK to RAS directions %s: %d triangles, volume %.0f mm3, analytic %.0f mm3'
+        % (directions, polyData.GetNumberOfPolys(), massProperties.GetVolume(), analyticVolume))
+      self.assertAlmostEqual(massProperties.GetVolume(), analyticVolume, delta=0.01 * analyticVolume)
+      # the point normals face away from the center of the ellipsoid
+      points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+      normals = numpy_support.vtk_to_numpy(polyData.GetPointData().GetNormals())
+      outwardFraction = numpy.mean(numpy.sum(normals * (points - points.mean(axis=0)), axis=1) > 0)
+      self.assertGreater(outwardFraction, 0.99)
+    slicer.mrmlScene.RemoveNode(imageNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('extractSurface test passed')
+
+  def test_SamplingFactor(self):
+    """ Check the Dice coefficient of the coarse and of the refined masks against the mask
+    computed at full resolution, on a head perforated by holes that the closing bridges,
+    and check that the refined masks fill the holes as the full resolution one does.
+    """
+    logic = VentriculostomySurfaceCutLogic()
+    shape = (90, 100, 80)
+    volumeNode = self.createHeadVolume(logic, "SamplingHead", shape)
+    center = [0.5 * size for size in shape]
+    k, j, i = numpy.ogrid[:shape[0], :shape[1], :shape[2]]
+    holeArray = numpy.zeros(shape, dtype=bool)
+    for offsetI, offsetK in [(0.0, 0.0), (12.0, -10.0), (-15.0, 8.0), (5.0, 20.0)]:
+      surfaceJ = center[1] + self.headSemiAxes[1] * math.sqrt(1.0 - (offsetI / self.headSemiAxes[0]) ** 2 - (offsetK / self.headSemiAxes[2]) ** 2)
+      holeArray |= ((i - center[2] - offsetI) ** 2 + (k - center[0] - offsetK) ** 2 <= 9) & (j >= surfaceJ - 8)
+    voxelArray = slicer.util.arrayFromVolume(volumeNode)
+    holeArray &= voxelArray > 0
+    voxelArray[holeArray] = 0
+    volumeNode.GetImageData().Modified()
+    modelNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLModelNode")
+    modelNode.SetName("SamplingSkin")
+    slicer.mrmlScene.AddNode(modelNode)
+    referenceImage = logic.imageFromVolume(volumeNode)
+
+    def holefilledImageOnInputGrid():
+      return sitk.Cast(sitk.Resample(logic.imageFromVolume(logic.holefilledImageNode), referenceImage,
+        sitk.Transform(), sitk.sitkNearestNeighbor), sitk.sitkUInt8)
+
+    logic.createModel(volumeNode, modelNode, 20.0)
+    fullImage = holefilledImageOnInputGrid()
+    fullArray = sitk.GetArrayFromImage(fullImage)
+    self.assertGreater(fullArray[holeArray].mean(), 0.9)
+    overlapFilter = sitk.LabelOverlapMeasuresImageFilter()
+    for samplingFactor, refineCoarseSurface, minimumDice in [(2, False, 0.95), (4, False, 0.9), (2, True, 0.99), (4, True, 0.99)]:
+      logic.samplingFactor = samplingFactor
+      logic.refineCoarseSurface = refineCoarseSurface
+      logic.createModel(volumeNode, modelNode, 20.0)
+      maskImage = holefilledImageOnInputGrid()
+      overlapFilter.Execute(fullImage, maskImage)
+      holeMismatch = numpy.count_nonzero(sitk.GetArrayFromImage(maskImage)[holeArray] != fullArray[holeArray])
+      logging.info('sampling factor %d, refined %s: Dice %.4f, %d of %d hole voxels differ'
+        % (samplingFactor, refineCoarseSurface, overlapFilter.GetDiceCoefficient(), holeMismatch, holeArray.sum()))
+      self.assertGreater(overlapFilter.GetDiceCoefficient(), minimumDice)
+      if refineCoarseSurface:
+        self.assertLessEqual(holeMismatch, 0.01 * holeArray.sum())
+    self.assertGreater(modelNode.GetPolyData().GetNumberOfPoints(), 0)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    slicer.mrmlScene.RemoveNode(modelNode)
+    logic.clear()
+    self.delayDisplay('Sampling factor test passed')